@@ -1,10 +1,19 @@
-from flask import Flask, jsonify, request
-from dataprocessing.main import DataProcessing
+from flask import Flask, Response, jsonify, request
+from dataprocessing.main import DataProcessing, OUTPUT_SHARDS
+from dataprocessing.cache import ResponseCache
+from dataprocessing.jobs import IngestJobs
+from dataprocessing.profiling import Profiler
+from dataprocessing.workqueue import DistributedIngest
+from dataprocessing.changefeed import ChangeFeed, MinioNotificationSource, PollingSource
+from dataprocessing import metrics, responseEncoding
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from werkzeug.http import generate_etag
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 from dataprocessing.minioConnect import MyMinio
-from dataprocessing.postgresConnect import MyPgConnect
+import math
 import os
+import time
 from decouple import config
 
 SRC_DATA_PATH = 'srcdata'
@@ -22,43 +31,244 @@ POSTGRES_HOST = os.getenv("POSTGRES_HOST", config("POSTGRES_HOST"))
 FLASK_RUN_HOST = os.getenv("FLASK_RUN_HOST", config("FLASK_RUN_HOST"))
 FLASK_RUN_PORT = int(os.getenv("FLASK_RUN_PORT", config("FLASK_RUN_PORT")))
 
+RESPONSE_CACHE_SIZE = config("RESPONSE_CACHE_SIZE", default=128, cast=int)
+RESPONSE_CACHE_TTL = config("RESPONSE_CACHE_TTL", default=60, cast=float)
+
+# 'interval' processes the data periodically, 'changefeed' also processes the changed files
+# as soon as the bucket notifications report them
+INGEST_MODE = config("INGEST_MODE", default='interval')
+SCHEDULER_INTERVAL = config("SCHEDULER_INTERVAL", default=600, cast=int)
+CHANGEFEED_DEBOUNCE = config("CHANGEFEED_DEBOUNCE", default=2, cast=float)
+CHANGEFEED_MAX_WAIT = config("CHANGEFEED_MAX_WAIT", default=30, cast=float)
+CHANGEFEED_POLL_INTERVAL = config("CHANGEFEED_POLL_INTERVAL", default=30, cast=float)
+
+# Split the processing between the replicas of the service through a work queue in postgres
+DISTRIBUTED_INGEST = config("DISTRIBUTED_INGEST", default=False, cast=bool)
+WORK_BATCH_SIZE = config("WORK_BATCH_SIZE", default=500, cast=int)
+WORK_LEASE_SECONDS = config("WORK_LEASE_SECONDS", default=600, cast=float)
+# How often a replica checks the queue for the work planned by another replica
+WORK_POLL_INTERVAL = config("WORK_POLL_INTERVAL", default=5, cast=int)
+# How often the changes made by the other replicas or by backfill.py are applied to the in-memory copy of the users
+READ_MODEL_REFRESH_INTERVAL = config("READ_MODEL_REFRESH_INTERVAL", default=60, cast=int)
+
 app = Flask(__name__)
 
-data_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH)
+data_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH, shared_locks=DISTRIBUTED_INGEST)
+
+# Cache of the responses of GET /data, invalidated each time the processed data changes
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+# Profiles a sample of the data processing runs and of the GET /data requests, see PROFILE_* in the .env
+profiler = Profiler(data_processor.minioClient)
+
+
+# Runs the data processing in the background. Overlapping requests from the API and
+# the scheduler are coalesced, so only one run happens at a time.
+if DISTRIBUTED_INGEST:
+    distributed_ingest = DistributedIngest(data_processor, batch_size=WORK_BATCH_SIZE,
+                                           lease_seconds=WORK_LEASE_SECONDS)
+    ingest_jobs = IngestJobs(profiler.wrap('ingest', distributed_ingest.run))
+else:
+    ingest_jobs = IngestJobs(profiler.wrap('ingest', data_processor.process_data))
 
 
 def process_data():
     """
     function to automate the process of processing the data
     """
-    data_processor.process_data()
+    ingest_jobs.submit('scheduler')
 
 
 scheduler = BackgroundScheduler()
 
 # Periodically process the data each 10 minutes
-scheduler.add_job(process_data, 'interval', seconds=600)
+scheduler.add_job(process_data, 'interval', seconds=SCHEDULER_INTERVAL)
+
+
+def process_queue():
+    """
+    Join the other replicas once there is work in the queue
+    """
+    if not ingest_jobs.active() and distributed_ingest.pending() > 0:
+        # no keys to queue, only process the queue
+        ingest_jobs.submit('queue', keys=[])
+
+
+if DISTRIBUTED_INGEST:
+    scheduler.add_job(process_queue, 'interval', seconds=WORK_POLL_INTERVAL)
+# See the users written by the other replicas and by backfill.py, and invalidate the cached responses
+scheduler.add_job(data_processor.sync_changes, 'interval', seconds=READ_MODEL_REFRESH_INTERVAL)
+
 scheduler.start()
 atexit.register(lambda: scheduler.shutdown())
+atexit.register(lambda: data_processor.pg_instance.close())
+
+if INGEST_MODE == 'changefeed':
+    # Process the changed files in micro-batches as soon as minio reports them. If the bucket
+    # notifications are not available, fall back to polling the bucket.
+    change_feed = ChangeFeed(
+        MinioNotificationSource(data_processor.minioClient, SRC_DATA_PATH),
+        lambda keys: ingest_jobs.submit('changefeed', keys),
+        fallback=PollingSource(data_processor.minioClient, SRC_DATA_PATH, CHANGEFEED_POLL_INTERVAL),
+        debounce=CHANGEFEED_DEBOUNCE, max_wait=CHANGEFEED_MAX_WAIT).start()
+    atexit.register(lambda: change_feed.stop())
 
 
 @app.route("/data", methods=['POST'])
-def process_data():
-    data_processor.process_data()
-    return jsonify("Data has been processed!")
+def submit_processing():
+    job = ingest_jobs.submit('api')
 
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers['Location'] = f"/jobs/{job['id']}"
+    return response
 
-@app.route("/data", methods=['GET'])
-def get_data():
-    # Read the filters
+
+@app.route("/jobs", methods=['GET'])
+def get_jobs():
+    return jsonify(ingest_jobs.recent())
+
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def get_job(job_id):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify(f"No job with id {job_id}"), 404
+    return jsonify(job)
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
+def read_filters():
+    """
+    Reads the filters of GET /data and GET /data/stats
+    :return: (filters, error) -> the filters of 'DataProcessing.get_data', where the ages are numbers or -1 if they
+    are not specified, or None and the error message if an age is not a number
+    """
     is_image_exists = request.args.get('is_image_exists', -1)
     if is_image_exists != -1:
         is_image_exists = is_image_exists.lower()
-    min_age_years = request.args.get('min_age', -1)
-    max_age_years = request.args.get('max_age', -1)
+    filters = dict(is_image_exists=is_image_exists)
+
+    for name in ('min_age', 'max_age'):
+        try:
+            age = float(request.args.get(name, -1))
+        except ValueError:
+            age = math.nan
+        if not math.isfinite(age):
+            return None, f"'{name}' should be a number"
+        filters[name] = age
+
+    return filters, None
+
+
+@app.route("/data/stats", methods=['GET'])
+def get_stats():
+    filters, error = read_filters()
+    if error is not None:
+        return jsonify(error), 400
+
+    age_bin = request.args.get('age_bin', 10, type=float)
+    if age_bin <= 0:
+        return jsonify("'age_bin' should be a positive number"), 400
+
+    return jsonify(data_processor.get_stats(age_bin, **filters))
+
+
+@app.route("/data", methods=['GET'])
+def get_data():
+    started = time.perf_counter()
+    # Profile the request if it is sampled or if it sends the profiling token in the 'X-Profile' header
+    with profiler.profile('request', 'get_data',
+                          profiler.should_profile('request', request.headers.get('X-Profile'))) as profile_name:
+        response, mode = read_data()
+    if profile_name is not None:
+        response = app.make_response(response)
+        response.headers['X-Profile-Path'] = f"{profiler.bucket_name}/{profile_name}.prof"
+
+    # The latency by combination of filters, e.g. 'is_image_exists,min_age', and by mode (all, page, stream)
+    filters = ','.join(name for name in ('is_image_exists', 'min_age', 'max_age') if name in request.args) or 'none'
+    metrics.GET_DATA_SECONDS.labels(filters, mode).observe(time.perf_counter() - started)
+
+    return response
+
+
+def read_data():
+    """
+    Answers GET /data
+    :return: (response, mode) -> the response and how the users were read: 'all', 'page', 'stream', 'since'
+    or 'invalid'
+    """
+    # Read the filters
+    filters, error = read_filters()
+    if error is not None:
+        return (jsonify(error), 400), 'invalid'
+
+    # Stream all the matching users as they are read from the DB
+    stream = request.args.get('stream')
+    if stream is not None:
+        output_format = 'ndjson' if stream.lower() == 'ndjson' else 'json'
+        mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+        return Response(data_processor.stream_data(output_format, **filters), mimetype=mimetype), 'stream'
+
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0:
+        return (jsonify("'limit' should be a positive integer"), 400), 'invalid'
+    after = request.args.get('after')
+    # Add the path of the thumbnail of the image of each user
+    thumbnails = request.args.get('thumbnails', 'false').lower() == 'true'
+
+    # Only the users that changed since the watermark of a previous request
+    since = request.args.get('since')
+    if since is not None:
+        if not since.isdigit():
+            return (jsonify("'since' should be the watermark of a previous response, or 0"), 400), 'invalid'
+        if any(name in request.args for name in ('is_image_exists', 'min_age', 'max_age', 'limit')):
+            return (jsonify("'since' cannot be combined with the filters or 'limit'"), 400), 'invalid'
+        response = jsonify(data_processor.get_changes(int(since), thumbnails))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response, 'since'
+
+    # Normalize the filters, so equivalent requests share the same cache entry
+    cache_key = ({'true': True, 'false': False}.get(filters['is_image_exists']),
+                 filters['min_age'] if filters['min_age'] != -1 else None,
+                 filters['max_age'] if filters['max_age'] != -1 else None,
+                 limit, after if limit is not None else None, thumbnails)
+
+    # The representation (json, columnar json or arrow) and the compression of the response
+    media_type = request.accept_mimetypes.best_match(responseEncoding.MEDIA_TYPES, default=responseEncoding.JSON)
+    content_encoding = request.accept_encodings.best_match(responseEncoding.CONTENT_ENCODINGS)
+    cache_key += (media_type, content_encoding)
+
+    version = data_processor.data_version
+    cached = response_cache.get(cache_key, version)
+
+    if cached is None:
+        # Encode the users as they are read, without a dict per user. With 'limit', return one page of the users.
+        columns, next_cursor = data_processor.get_data_columns(limit, after, thumbnails, **filters)
+        if media_type != responseEncoding.JSON:
+            body = responseEncoding.encode_columns(media_type, columns, next_cursor, paged=limit is not None)
+        else:
+            body = responseEncoding.encode_keyed_json(columns, next_cursor, paged=limit is not None)
+
+        body = responseEncoding.compress(body, content_encoding)
+        cached = (body, generate_etag(body))
+        response_cache.put(cache_key, version, cached)
+
+    body, etag = cached
+
+    response = app.response_class(body, mimetype=media_type)
+    if content_encoding is not None:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
 
-    data = data_processor.get_data(is_image_exists=is_image_exists, min_age=min_age_years, max_age=max_age_years)
-    return jsonify(data)
+    # Answer with 304 Not Modified if the client already has this version of the data
+    return response.make_conditional(request), 'page' if limit is not None else 'all'
 
 
 if __name__ == "__main__":
@@ -70,19 +280,23 @@ if __name__ == "__main__":
     myMinioClient.create_bucket(SRC_DATA_PATH)
     myMinioClient.create_bucket(PROCESSED_DATA_PATH)
 
-    # Create the output file
-    try:
-        myMinioClient.read_csv_file_from_minio(PROCESSED_DATA_PATH, 'output.csv')
-    except:
+    # Create the output file, the sharded results do not use it
+    if OUTPUT_SHARDS == 0 and not myMinioClient.file_exists(PROCESSED_DATA_PATH, 'output.csv'):
         header = "user_id,first_name,last_name,birthts,img_path"
         myMinioClient.add_file(PROCESSED_DATA_PATH, 'output.csv', header)
 
-    # connect to pgadmin
-    pg_instance = MyPgConnect(dbname='internship', user=POSTGRES_USER,
-                              password=POSTGRES_PASSWORD, host=POSTGRES_HOST)
+    # connect to postgres through the connection pool that is shared by the flask app and the scheduler
+    pg_instance = data_processor.pg_instance
 
     # create the main table
     pg_instance.create_table_users()
+    pg_instance.create_table_manifest()
+    pg_instance.create_table_quarantine()
+    pg_instance.create_table_bulk_file_ids()
+    if DISTRIBUTED_INGEST:
+        pg_instance.create_table_work_queue()
+    if data_processor.image_derivatives is not None:
+        pg_instance.create_table_image_derivatives()
 
     # run the flask app
     app.run(host=FLASK_RUN_HOST, port=FLASK_RUN_PORT)
@@ -0,0 +1,143 @@
+import argparse
+import bisect
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dataprocessing.main import DataProcessing
+from dataprocessing.utils.helpers import file_to_user_id
+
+SRC_DATA_PATH = 'srcdata'
+PROCESSED_DATA_PATH = 'processeddata'
+
+CHECKPOINTS_TABLE = 'backfill_ranges'
+
+# The data processing of each process of the pool, see 'init_worker'
+data_processor = None
+
+
+def init_worker():
+    global data_processor
+    # the processes write the same results files, so they take turns through the locks in postgres
+    data_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH, shared_locks=True)
+
+
+def process_range(files: list, files_info: dict, incremental: bool):
+    """
+    Processes the users of a range in a process of the pool
+    :param files: the source files of the users of the range, listed or recorded in the manifest
+    :param files_info: the listing of the files of the range
+    :return: the summary of 'DataProcessing.process_data'
+    """
+    return data_processor.process_data(incremental, keys=files, files_info=files_info)
+
+
+def plan_ranges(keys: list, range_size: int):
+    """
+    Splits the sorted keys of the users into ranges of 'range_size' keys
+    :return: the first key of each range, the first range starts with ''
+    """
+    return [''] + keys[range_size::range_size]
+
+
+def format_duration(seconds: float):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+if __name__ == "__main__":
+    # Rebuilds the processed data and the users table from the whole source bucket. The users are split into
+    # ranges of ids that are processed in parallel, and each completed range is checkpointed in postgres,
+    # so an interrupted backfill resumes where it stopped when the same command is run again.
+    parser = argparse.ArgumentParser(description="Process the whole source bucket in resumable ranges")
+    parser.add_argument('--id', default='backfill', help="the id of the backfill, to resume it")
+    parser.add_argument('--range-size', type=int, default=1000, help="the number of users per range")
+    parser.add_argument('--processes', type=int, default=None, help="the number of CPUs by default")
+    parser.add_argument('--incremental', action='store_true',
+                        help="skip the files that did not change since they were processed, and delete the users "
+                             "whose files were removed")
+    parser.add_argument('--restart', action='store_true',
+                        help="plan the ranges again and process all of them, instead of resuming")
+    args = parser.parse_args()
+
+    main_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH, shared_locks=True)
+    pg_instance = main_processor.pg_instance
+    pg_instance.create_table_users()
+    pg_instance.create_table_manifest()
+    pg_instance.create_table_quarantine()
+    pg_instance.create_table_bulk_file_ids()
+    pg_instance.create_table_backfill_ranges()
+    if main_processor.image_derivatives is not None:
+        pg_instance.create_table_image_derivatives()
+
+    # List the bucket once, the ranges get their part of the listing
+    files_info = main_processor.minioClient.get_files_info(SRC_DATA_PATH)
+    files = set(files_info)
+    if args.incremental:
+        # the files that were removed since they were processed, so their users are deleted
+        files.update(pg_instance.get_manifest('manifest'))
+    keys = sorted({file_to_user_id(file) for file in files})
+
+    ranges = [] if args.restart else pg_instance.get_backfill_ranges(CHECKPOINTS_TABLE, args.id)
+    if len(ranges) == 0:
+        pg_instance.plan_backfill_ranges(CHECKPOINTS_TABLE, args.id, plan_ranges(keys, args.range_size))
+        ranges = pg_instance.get_backfill_ranges(CHECKPOINTS_TABLE, args.id)
+    else:
+        print(f"Resuming the backfill '{args.id}': {sum(summary is not None for _, _, summary in ranges)} "
+              f"of {len(ranges)} ranges already completed, use --restart to start over")
+
+    # The ranges keep their bounds when a backfill is resumed, and every key falls into one of them,
+    # including the keys of the files added since the backfill started
+    starts = [start for start, _, _ in ranges]
+    range_files = [[] for _ in ranges]
+    for file in sorted(files):
+        range_files[bisect.bisect_right(starts, file_to_user_id(file)) - 1].append(file)
+
+    pending = [index for index, (_, _, summary) in enumerate(ranges) if summary is None and range_files[index]]
+    total_users = sum(len({file_to_user_id(file) for file in range_files[index]}) for index in pending)
+    print(f"Processing {total_users} users in {len(pending)} ranges")
+
+    started = time.monotonic()
+    done_users = done_bytes = done_ranges = 0
+    failed = []
+
+    # the processes are spawned, so they do not inherit the connections of this process
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=init_worker,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(process_range, range_files[index],
+                                   {file: files_info[file] for file in range_files[index] if file in files_info},
+                                   args.incremental): index
+                   for index in pending}
+
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                print(f"Range {index} failed: {e}")
+                pg_instance.checkpoint_backfill_range(CHECKPOINTS_TABLE, args.id, index,
+                                                      error=str(e) or type(e).__name__)
+                failed.append(index)
+                continue
+
+            pg_instance.checkpoint_backfill_range(CHECKPOINTS_TABLE, args.id, index, summary)
+
+            done_ranges += 1
+            done_users += len({file_to_user_id(file) for file in range_files[index]})
+            done_bytes += sum(files_info[file][1] or 0 for file in range_files[index] if file in files_info)
+            elapsed = time.monotonic() - started
+            rate = done_users / elapsed
+            remaining = (total_users - done_users) / rate if rate > 0 else 0
+            print(f"Range {index} done ({done_ranges + len(failed)}/{len(pending)}): {done_users}/{total_users} users, "
+                  f"{rate:.0f} users/s, {done_bytes / 1024 ** 2 / elapsed:.1f} MiB/s, "
+                  f"{format_duration(remaining)} left")
+
+    main_processor.pg_instance.close()
+
+    print(f"Processed {done_users} users in {done_ranges} ranges in {format_duration(time.monotonic() - started)}")
+    # the running services apply the changes of the users with 'DataProcessing.sync_changes'
+    print("The running services serve the backfilled users within READ_MODEL_REFRESH_INTERVAL seconds")
+    if failed:
+        print(f"{len(failed)} ranges failed: {sorted(failed)}, run the same command again to retry them")
+        raise SystemExit(1)
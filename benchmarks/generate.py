@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+
+# The number of users of each benchmark scale
+SCALES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+
+FIRST_NAMES = ['Susan', 'James', 'Mary', 'John', 'Linda', 'Robert', 'Karen', 'Michael', 'Lisa', 'David',
+               'Nancy', 'William', 'Betty', 'Richard', 'Sandra', 'Joseph', 'Ashley', 'Thomas', 'Emily', 'Daniel']
+LAST_NAMES = ['Lee', 'Smith', 'Johnson', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Wilson', 'Moore',
+              'Taylor', 'Anderson', 'Thomas', 'Jackson', 'White', 'Harris', 'Martin', 'Clark', 'Lewis', 'Young']
+
+# The birth timestamps ms of the generated users are between 1950 and 2005
+MIN_BIRTHTS = -631152000000
+MAX_BIRTHTS = 1104537600000
+
+# A valid 1x1 png image
+IMAGE = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                      '1f15c4890000000d4944415478da63f8ffff3f0005fe02fea73581e40000000049454e44ae426082')
+
+
+def generate_users(count: int, seed: int = 0, image_ratio: float = 0.5, first_id: int = 1000):
+    """
+    Generates the data of synthetic users. The same arguments always generate the same users.
+    :param count: the number of users
+    :param seed: the seed of the random generator
+    :param image_ratio: the probability that a user has an image
+    :param first_id: the id of the first user, the ids are consecutive numbers as in 'src_data'
+    :return: a generator of tuples of the format (user_id, first_name, last_name, birthts, has_image)
+    """
+    rand = random.Random(seed)
+    for i in range(count):
+        yield (str(first_id + i), rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES),
+               rand.randint(MIN_BIRTHTS, MAX_BIRTHTS), rand.random() < image_ratio)
+
+
+def generate_src_files(count: int, seed: int = 0, image_ratio: float = 0.5):
+    """
+    Generates the source files of synthetic users in the format of 'src_data': a csv file
+    '<user_id>.csv' with the header 'first_name, last_name, birthts' and one row per user,
+    and an image '<user_id>.png' for some of the users.
+    :return: a generator of tuples of the format (file_name, content)
+    """
+    for user_id, first_name, last_name, birthts, has_image in generate_users(count, seed, image_ratio):
+        yield f"{user_id}.csv", f"first_name, last_name, birthts\n{first_name}, {last_name}, {birthts}\n".encode()
+        if has_image:
+            yield f"{user_id}.png", IMAGE
+
+
+def write_src_files(local_path: str, count: int, seed: int = 0, image_ratio: float = 0.5):
+    """
+    Writes the source files of synthetic users to a local directory, e.g. to upload them to a real minio
+    with 'MyMinio.upload_local_directory_to_minio'
+    :return: the number of written files
+    """
+    os.makedirs(local_path, exist_ok=True)
+
+    written = 0
+    for file_name, content in generate_src_files(count, seed, image_ratio):
+        with open(os.path.join(local_path, file_name), 'wb') as file:
+            file.write(content)
+        written += 1
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the source files of synthetic users to a directory")
+    parser.add_argument('local_path')
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"Wrote {write_src_files(args.local_path, SCALES[args.scale], args.seed, args.image_ratio)} files "
+          f"to {args.local_path}")
@@ -0,0 +1,236 @@
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from benchmarks.generate import SCALES, generate_src_files, generate_users
+from benchmarks.standins import InMemoryMinio, InMemoryPg
+from dataprocessing.main import DataProcessing
+from dataprocessing.utils.helpers import dict_to_db_row, NO_IMAGE
+
+SRC_DATA_PATH = 'srcdata'
+PROCESSED_DATA_PATH = 'processeddata'
+
+
+class Recorder:
+
+    def __init__(self, trace_memory: bool = True):
+        """
+        Measures the duration and the peak memory of the benchmarks and of the stages of 'process_data'.
+        The peak memory of a benchmark or a stage is the peak of the memory allocated since it started,
+        as traced by tracemalloc. Tracing slows python down, so the durations are only comparable between
+        reports made with the same 'trace_memory'.
+        :param trace_memory: if False, only the durations are measured
+        """
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def _restart_tracing(self):
+        if self.trace_memory:
+            tracemalloc.stop()
+            tracemalloc.start()
+
+    def _peak(self):
+        return tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+
+    def measure(self, name: str, func, *args, **kwargs):
+        """
+        Runs a benchmark and records its measures. If the benchmark accepts a 'progress' callback,
+        e.g. 'DataProcessing.process_data', pass progress=True to also measure each of its stages.
+        :return: the return value of the benchmark
+        """
+        stages = {}
+        current = {}
+
+        def progress(stage: str, done: int = None, total: int = None):
+            if current.get('stage') == stage:
+                return
+            now = time.perf_counter()
+            if 'stage' in current:
+                stages[current['stage']] = {'seconds': now - current['started'], 'peak_memory': self._peak()}
+                self._restart_tracing()
+            current.update(stage=stage, started=now)
+
+        if kwargs.get('progress') is True:
+            kwargs['progress'] = progress
+
+        peaks = []
+        self._restart_tracing()
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        finished = time.perf_counter()
+
+        if 'stage' in current:
+            stages[current['stage']] = {'seconds': finished - current['started'], 'peak_memory': self._peak()}
+            peaks = [stage['peak_memory'] for stage in stages.values()]
+
+        self.results.append({
+            'name': name,
+            'seconds': finished - started,
+            # with stages, the tracing restarts at each stage, so the peak of the benchmark is the peak of its stages
+            'peak_memory': max(peaks) if peaks and self.trace_memory else self._peak(),
+            'stages': stages,
+        })
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_pg(args):
+    """
+    Creates the postgres client of the benchmarks: the in-memory stand-in, or a real postgres if '--pg-host'
+    is given. The tables of the benchmarks in a real postgres are dropped first, so use a scratch database.
+    """
+    if args.pg_host is None:
+        pg_instance = InMemoryPg()
+    else:
+        from dataprocessing.postgresConnect import MyPgConnect
+        pg_instance = MyPgConnect(dbname=args.pg_db, user=args.pg_user, password=args.pg_password,
+                                  host=args.pg_host)
+        for table_name in ('users', 'users_tombstones', 'manifest', 'quarantine'):
+            pg_instance.delete_table(table_name)
+
+    pg_instance.create_table_users()
+    pg_instance.create_table_manifest()
+    pg_instance.create_table_quarantine()
+    return pg_instance
+
+
+def run_benchmarks(args):
+    count = SCALES[args.scale]
+    recorder = Recorder(trace_memory=not args.no_memory)
+
+    minio_client = InMemoryMinio()
+    minio_client.create_bucket(PROCESSED_DATA_PATH)
+    pg_instance = make_pg(args)
+    data_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH,
+                                    minio_client=minio_client, pg_instance=pg_instance)
+
+    recorder.measure('generate', minio_client.put_files, SRC_DATA_PATH,
+                     generate_src_files(count, args.seed, args.image_ratio))
+
+    recorder.measure('process_data/full', data_processor.process_data, progress=True)
+    recorder.measure('process_data/unchanged', data_processor.process_data, progress=True)
+
+    # change 1% of the users, with different names than the first run
+    changed = max(1, count // 100)
+    recorder.measure('generate/changes', minio_client.put_files, SRC_DATA_PATH,
+                     ((file_name, content) for file_name, content
+                      in generate_src_files(changed, args.seed + 1, args.image_ratio) if file_name.endswith('.csv')))
+    recorder.measure('process_data/incremental', data_processor.process_data, progress=True)
+
+    filters = {
+        'all': {'is_image_exists': -1, 'min_age': -1, 'max_age': -1},
+        'image_age': {'is_image_exists': 'true', 'min_age': 20, 'max_age': 40},
+    }
+    for name, user_filters in filters.items():
+        for _ in range(args.repeat):
+            recorder.measure(f'get_data/{name}', data_processor.get_data, **user_filters)
+        recorder.measure(f'get_data_page/{name}', data_processor.get_data_page, 100, **user_filters)
+        recorder.measure(f'stream_data/{name}', lambda: sum(len(chunk) for chunk in
+                                                            data_processor.stream_data('ndjson', **user_filters)))
+
+    # upsert users that are not in the table yet, then the same users again (all unchanged)
+    rows = [item for user_id, first_name, last_name, birthts, has_image in
+            generate_users(count, args.seed + 2, args.image_ratio, first_id=10 ** 9)
+            for item in dict_to_db_row({'user_id': user_id, 'first_name': first_name, 'last_name': last_name,
+                                        'birthts': birthts, 'img_path': f"{SRC_DATA_PATH}/{user_id}.png"
+                                        if has_image else NO_IMAGE})]
+    recorder.measure('insert_users/new', pg_instance.insert_users, 'users', rows)
+    recorder.measure('insert_users/unchanged', pg_instance.insert_users, 'users', rows)
+
+    pg_instance.close()
+
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'scale': args.scale,
+        'users': count,
+        'seed': args.seed,
+        'pg': 'memory' if args.pg_host is None else 'postgres',
+        'trace_memory': recorder.trace_memory,
+        # a benchmark that is repeated keeps its fastest run
+        'results': merge_repeats(recorder.results),
+    }
+
+
+def merge_repeats(results: list):
+    merged = {}
+    for result in results:
+        if result['name'] not in merged or result['seconds'] < merged[result['name']]['seconds']:
+            merged[result['name']] = result
+    return [merged[name] for name in dict.fromkeys(result['name'] for result in results)]
+
+
+def format_bytes(size):
+    if size is None:
+        return '-'
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"commit {report['commit']}, python {report['python']}, {report['users']} users, "
+          f"pg={report['pg']}, trace_memory={report['trace_memory']}")
+
+    baseline_results = {result['name']: result for result in baseline['results']} if baseline else {}
+    if baseline and (baseline['users'], baseline['pg'], baseline['trace_memory']) != \
+            (report['users'], report['pg'], report['trace_memory']):
+        print(f"warning: the baseline was made with {baseline['users']} users, pg={baseline['pg']}, "
+              f"trace_memory={baseline['trace_memory']}")
+
+    for result in report['results']:
+        line = f"{result['name']:<28} {result['seconds']:>10.3f}s {format_bytes(result['peak_memory']):>12}"
+        old = baseline_results.get(result['name'])
+        if old is not None and old['seconds'] > 0:
+            line += f"   x{result['seconds'] / old['seconds']:.2f} vs {baseline['commit']}"
+        print(line)
+
+        for stage, measures in result['stages'].items():
+            line = f"  {stage:<26} {measures['seconds']:>10.3f}s {format_bytes(measures['peak_memory']):>12}"
+            old_stage = old['stages'].get(stage) if old is not None else None
+            if old_stage is not None and old_stage['seconds'] > 0:
+                line += f"   x{measures['seconds'] / old_stage['seconds']:.2f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data processing with in-memory minio and postgres")
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image-ratio', type=float, default=0.5)
+    parser.add_argument('--repeat', type=int, default=3, help="the number of runs of the read benchmarks")
+    parser.add_argument('--no-memory', action='store_true', help="do not trace the memory, for exact durations")
+    parser.add_argument('--output', help="write the report to this json file")
+    parser.add_argument('--compare', help="a json report of a previous run to compare with")
+    parser.add_argument('--pg-host', help="benchmark a real postgres instead of the in-memory stand-in")
+    parser.add_argument('--pg-db', default='benchmarks')
+    parser.add_argument('--pg-user', default='postgres')
+    parser.add_argument('--pg-password', default='')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,278 @@
+import bisect
+import datetime
+import hashlib
+import io
+import threading
+from contextlib import contextmanager
+
+from minio.error import S3Error
+
+from dataprocessing.minioConnect import MyMinio
+
+
+class _Object:
+
+    def __init__(self, object_name: str, content: bytes):
+        self.object_name = object_name
+        self.size = len(content)
+        self.etag = hashlib.md5(content).hexdigest()
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+        self.is_dir = False
+
+
+class _Response(io.BytesIO):
+    """
+    The response of 'get_object', a readable stream like the urllib3 responses returned by minio
+    """
+    auto_close = True
+
+    def release_conn(self):
+        pass
+
+
+class InMemoryObjectStore:
+    """
+    An in-memory stand-in for the 'minio.Minio' client, implementing the calls made by 'MyMinio'
+    """
+
+    def __init__(self):
+        # {bucket_name: {object_name: (object, content)}} and the sorted names of the objects of each bucket
+        self._buckets = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def _not_found(self, bucket_name: str, object_name: str):
+        return S3Error('NoSuchKey', 'The specified key does not exist.', f"/{bucket_name}/{object_name}",
+                       None, None, None, bucket_name, object_name)
+
+    def bucket_exists(self, bucket_name: str):
+        return bucket_name in self._buckets
+
+    def make_bucket(self, bucket_name: str):
+        with self._lock:
+            self._buckets.setdefault(bucket_name, {})
+            self._names.setdefault(bucket_name, [])
+
+    def put_object(self, bucket_name: str, object_name: str, data, length: int, **kwargs):
+        content = data.read(length) if length >= 0 else data.read()
+        with self._lock:
+            objects, names = self._buckets[bucket_name], self._names[bucket_name]
+            if object_name not in objects:
+                bisect.insort(names, object_name)
+            objects[object_name] = (_Object(object_name, content), content)
+
+    def fput_object(self, bucket_name: str, object_name: str, file_path: str, **kwargs):
+        with open(file_path, 'rb') as file:
+            self.put_object(bucket_name, object_name, file, -1)
+
+    def copy_object(self, bucket_name: str, object_name: str, source, **kwargs):
+        obj = self.stat_object(source.bucket_name, source.object_name)
+        if source.match_etag is not None and source.match_etag != obj.etag:
+            raise S3Error('PreconditionFailed', 'At least one of the pre-conditions you specified did not hold',
+                          f"/{source.bucket_name}/{source.object_name}", None, None, None)
+        content = self._buckets[source.bucket_name][source.object_name][1]
+        self.put_object(bucket_name, object_name, io.BytesIO(content), len(content))
+
+    def get_object(self, bucket_name: str, object_name: str, **kwargs):
+        try:
+            return _Response(self._buckets[bucket_name][object_name][1])
+        except KeyError:
+            raise self._not_found(bucket_name, object_name)
+
+    def stat_object(self, bucket_name: str, object_name: str, **kwargs):
+        try:
+            return self._buckets[bucket_name][object_name][0]
+        except KeyError:
+            raise self._not_found(bucket_name, object_name)
+
+    def list_objects(self, bucket_name: str, prefix: str = None, recursive: bool = False, **kwargs):
+        prefix = prefix or ''
+        with self._lock:
+            objects, names = self._buckets[bucket_name], self._names[bucket_name]
+            names = names[bisect.bisect_left(names, prefix):]
+            listed = []
+            for name in names:
+                if not name.startswith(prefix):
+                    break
+                listed.append(objects[name][0])
+
+        if recursive:
+            return iter(listed)
+
+        # like minio, the objects under a '/' after the prefix are listed as a single directory
+        directories, top = set(), []
+        for obj in listed:
+            rest = obj.object_name[len(prefix):]
+            if '/' in rest:
+                directory = prefix + rest.split('/', 1)[0] + '/'
+                if directory not in directories:
+                    directories.add(directory)
+                    top.append(_Object(directory, b''))
+                    top[-1].is_dir = True
+            else:
+                top.append(obj)
+        return iter(top)
+
+    def remove_object(self, bucket_name: str, object_name: str):
+        self.remove_objects(bucket_name, [object_name])
+
+    def remove_objects(self, bucket_name: str, delete_object_list):
+        with self._lock:
+            objects, names = self._buckets[bucket_name], self._names[bucket_name]
+            for delete_object in delete_object_list:
+                object_name = getattr(delete_object, '_name', delete_object)
+                if objects.pop(object_name, None) is not None:
+                    names.pop(bisect.bisect_left(names, object_name))
+        # the errors of the deletions, there are none
+        return iter([])
+
+    def listen_bucket_notification(self, bucket_name: str, **kwargs):
+        raise NotImplementedError("The in-memory object store does not send notifications")
+
+
+class InMemoryMinio(MyMinio):
+    """
+    A 'MyMinio' whose objects are kept in memory, so the code of 'MyMinio' is measured without a minio server
+    """
+
+    def __init__(self):
+        super().__init__(access='', secret='')
+
+    def _getMinioClient(self):
+        return InMemoryObjectStore()
+
+    def put_files(self, bucket_name: str, files):
+        """
+        Adds files to a bucket, creating the bucket if needed
+        :param files: an iterable of tuples of the format (file_name, content)
+        :return: the number of added files
+        """
+        self.create_bucket(bucket_name)
+        added = 0
+        for file_name, content in files:
+            self.minioClient.put_object(bucket_name, file_name, io.BytesIO(content), len(content))
+            added += 1
+        return added
+
+
+class InMemoryPg:
+    """
+    An in-memory stand-in for 'MyPgConnect', implementing the calls made by 'DataProcessing'
+    with the same semantics. The tables are dicts, so the timings measure the pipeline, not the DB.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self._lock = threading.RLock()
+        # the counter that stands for the transaction ids of the changes of the users, and the ids of the
+        # changes of the users and of the deleted users: {table_name: {user_id: change}}
+        self._change = 0
+        self.changes = {}
+        self.tombstones = {}
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            yield self
+
+    def close(self):
+        pass
+
+    def create_table_users(self):
+        self.tables.setdefault('users', {})
+        self.changes.setdefault('users', {})
+        self.tombstones.setdefault('users', {})
+
+    def create_table_manifest(self):
+        self.tables.setdefault('manifest', {})
+
+    def create_table_quarantine(self):
+        self.tables.setdefault('quarantine', {})
+
+    def delete_table(self, table_name: str):
+        self.tables.pop(table_name, None)
+
+    def clear_table(self, table_name: str):
+        self.tables[table_name] = {}
+
+    def get_manifest(self, table_name: str, user_ids: list = None):
+        with self._lock:
+            manifest = self.tables[table_name]
+            if user_ids is None:
+                return dict(manifest)
+            user_ids = set(user_ids)
+            return {file_name: info for file_name, info in manifest.items()
+                    if file_name.split('.', 1)[0] in user_ids}
+
+    def update_manifest(self, table_name: str, processed: dict, removed: list):
+        with self._lock:
+            manifest = self.tables[table_name]
+            manifest.update({file_name: tuple(info) for file_name, info in processed.items()})
+            for file_name in removed:
+                manifest.pop(file_name, None)
+
+    def record_quarantine(self, table_name: str, files: dict):
+        with self._lock:
+            self.tables[table_name].update({file_name: tuple(info) for file_name, info in files.items()})
+
+    def delete_rows_by_ids(self, table_name: str, ids: list):
+        with self._lock:
+            for user_id in ids:
+                self.tables[table_name].pop(user_id, None)
+
+    def delete_users(self, table_name: str, ids: list):
+        with self._lock:
+            self._change += 1
+            for user_id in ids:
+                if self.tables[table_name].pop(user_id, None) is not None:
+                    self.changes[table_name].pop(user_id)
+                    self.tombstones[table_name][user_id] = self._change
+
+    def insert_users(self, table_name: str, users: list, chunk_size: int = 50000):
+        inserted, updated = 0, 0
+        with self._lock:
+            self._change += 1
+            table = self.tables[table_name]
+            for i in range(0, len(users), 5):
+                row = tuple(users[i:i + 5])
+                old_row = table.get(row[0])
+                if old_row is None:
+                    inserted += 1
+                    self.tombstones[table_name].pop(row[0], None)
+                elif old_row != row:
+                    updated += 1
+                else:
+                    continue
+                table[row[0]] = row
+                self.changes[table_name][row[0]] = self._change
+        return inserted, updated
+
+    def get_changes_watermark(self):
+        with self._lock:
+            return self._change + 1
+
+    def get_users_changes(self, table_name: str, since: int):
+        with self._lock:
+            watermark = self._change + 1
+            rows = [self.tables[table_name][user_id] for user_id, change in self.changes[table_name].items()
+                    if change >= since]
+            deleted_ids = [user_id for user_id, change in self.tombstones[table_name].items() if change >= since]
+        return rows, deleted_ids, watermark
+
+    def get_users_data(self, table_name: str, has_image: bool = None,
+                       min_birthts: int = None, max_birthts: int = None, after: str = None, limit: int = None):
+        with self._lock:
+            rows = list(self.tables[table_name].values())
+
+        rows = [row for row in rows
+                if (has_image is None or (row[4] is not None) == has_image)
+                and (min_birthts is None or row[3] >= min_birthts)
+                and (max_birthts is None or row[3] <= max_birthts)
+                and (after is None or row[0] > after)]
+        if after is not None or limit is not None:
+            rows.sort()
+        return rows[:limit] if limit is not None else rows
+
+    def iter_users_data(self, table_name: str, has_image: bool = None,
+                        min_birthts: int = None, max_birthts: int = None, batch_size: int = 1000):
+        return iter(self.get_users_data(table_name, has_image, min_birthts, max_birthts))
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries: int = 128, ttl: float = 60):
+        """
+        A thread-safe LRU cache with a time to live. Each entry is stored alongside the version of the data it
+        was computed from, and it is ignored once the data gets a new version.
+        :param max_entries: the maximum number of entries, the least recently used entry is evicted first
+        :param ttl: the number of seconds an entry stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version: int):
+        """
+        Gets an entry from the cache
+        :param key: the key of the entry
+        :param version: the current version of the data
+        :return: the value of the entry, or None if it does not exist, expired or is of an older version
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, entry_version, expires_at = entry
+            if entry_version != version or time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, version: int, value):
+        """
+        Adds an entry to the cache
+        :param key: the key of the entry
+        :param version: the version of the data the value was computed from
+        :param value: the value of the entry
+        """
+        with self._lock:
+            self._entries[key] = (value, version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all the entries of the cache
+        """
+        with self._lock:
+            self._entries.clear()
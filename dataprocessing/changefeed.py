@@ -0,0 +1,238 @@
+import queue
+import threading
+import time
+
+from dataprocessing.minioConnect import MyMinio
+
+
+class ChangeSource:
+    """
+    A source of the changes of the files inside a bucket. Subclasses implement 'changes', a generator of
+    tuples of the format (event, file_name) where event is 'put' or 'delete'. The generator may block while
+    waiting for changes, should return once 'close' is called, and raises if the source stops working.
+    """
+
+    def changes(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MinioNotificationSource(ChangeSource):
+
+    def __init__(self, minioClient: MyMinio, bucket_name: str, max_failures: int = 3,
+                 retry_delay: float = 5, healthy_after: float = 60):
+        """
+        Listens to the bucket notifications of minio, reconnecting when the connection drops.
+        :param minioClient: the minio client
+        :param bucket_name: the name of the bucket to listen to
+        :param max_failures: the number of consecutive failed connections after which the source gives up
+        :param retry_delay: the number of seconds to wait before reconnecting
+        :param healthy_after: a connection that lived for this number of seconds, or delivered a change,
+        resets the number of consecutive failures
+        """
+        self.minioClient = minioClient
+        self.bucket_name = bucket_name
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        self.healthy_after = healthy_after
+
+        self._closed = threading.Event()
+
+    def changes(self):
+        failures = 0
+
+        while not self._closed.is_set():
+            connected_at = time.monotonic()
+            try:
+                for change in self.minioClient.listen_bucket_changes(self.bucket_name):
+                    failures = 0
+                    yield change
+                    if self._closed.is_set():
+                        return
+            except Exception as e:
+                if time.monotonic() - connected_at >= self.healthy_after:
+                    failures = 0
+                failures += 1
+                if failures >= self.max_failures:
+                    raise
+                print(f"Lost the notifications of bucket {self.bucket_name}, reconnecting: {e}")
+
+            self._closed.wait(self.retry_delay)
+
+    def close(self):
+        self._closed.set()
+
+
+class PollingSource(ChangeSource):
+
+    def __init__(self, minioClient: MyMinio, bucket_name: str, interval: float = 30):
+        """
+        Lists the bucket periodically and reports the differences with the previous listing.
+        The files that exist when the source starts are not reported.
+        :param minioClient: the minio client
+        :param bucket_name: the name of the bucket to poll
+        :param interval: the number of seconds between two listings
+        """
+        self.minioClient = minioClient
+        self.bucket_name = bucket_name
+        self.interval = interval
+
+        self._closed = threading.Event()
+
+    def changes(self):
+        previous = self.minioClient.get_files_info(self.bucket_name)
+
+        while not self._closed.wait(self.interval):
+            current = self.minioClient.get_files_info(self.bucket_name)
+
+            for file_name, info in current.items():
+                if file_name not in previous or tuple(previous[file_name][:2]) != tuple(info[:2]):
+                    yield 'put', file_name
+            for file_name in previous:
+                if file_name not in current:
+                    yield 'delete', file_name
+
+            previous = current
+
+    def close(self):
+        self._closed.set()
+
+
+class QueueSource(ChangeSource):
+    """
+    A source whose changes are pushed by hand, e.g. to test the change feed without minio.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def push(self, event: str, file_name: str):
+        """
+        Reports a change
+        :param event: 'put' or 'delete'
+        :param file_name: the name of the changed file
+        """
+        self._queue.put((event, file_name))
+
+    def changes(self):
+        while True:
+            change = self._queue.get()
+            if change is None:
+                return
+            yield change
+
+    def close(self):
+        self._queue.put(None)
+
+
+class DebouncedBatcher:
+
+    def __init__(self, on_batch, debounce: float = 2, max_wait: float = 30, max_batch_size: int = 10000):
+        """
+        Groups the changed files into micro-batches. A batch is handed to 'on_batch' once no change arrived
+        for 'debounce' seconds, once its first change is 'max_wait' seconds old, or once it contains
+        'max_batch_size' files, whichever comes first.
+        :param on_batch: the function that processes a batch, called as on_batch(file_names)
+        with the set of the changed files
+        """
+        self.on_batch = on_batch
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+
+        self._batch = set()
+        self._first_change = None
+        self._last_change = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._flusher = threading.Thread(target=self._flush_batches, name='changefeed-batcher', daemon=True)
+        self._flusher.start()
+
+    def add(self, file_name: str):
+        """
+        Adds a changed file to the current batch
+        :param file_name: the name of the changed file
+        """
+        with self._condition:
+            now = time.monotonic()
+            if not self._batch:
+                self._first_change = now
+            self._last_change = now
+            self._batch.add(file_name)
+            self._condition.notify()
+
+    def close(self):
+        """
+        Hands the current batch (if any) to 'on_batch' and stops the batcher
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._flusher.join()
+
+    def _flush_batches(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._batch:
+                        now = time.monotonic()
+                        deadline = min(self._last_change + self.debounce, self._first_change + self.max_wait)
+                        if self._closed or now >= deadline or len(self._batch) >= self.max_batch_size:
+                            break
+                        self._condition.wait(deadline - now)
+                    elif self._closed:
+                        return
+                    else:
+                        self._condition.wait()
+
+                batch, self._batch = self._batch, set()
+
+            try:
+                self.on_batch(batch)
+            except Exception as e:
+                print(e)
+
+
+class ChangeFeed:
+
+    def __init__(self, source: ChangeSource, on_batch, fallback: ChangeSource = None, **batcher_options):
+        """
+        Feeds the changes of a source into a debounced micro-batch processor. If the source fails,
+        the feed switches to the 'fallback' source (if any).
+        :param source: the main source of the changes
+        :param on_batch: the function that processes a batch of changed files, see 'DebouncedBatcher'
+        :param fallback: the source to use once 'source' fails, e.g. a 'PollingSource'
+        :param batcher_options: the options of the 'DebouncedBatcher'
+        """
+        self.sources = [source] + ([fallback] if fallback is not None else [])
+        self.batcher = DebouncedBatcher(on_batch, **batcher_options)
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._consume, name='changefeed', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the feed after handing the pending changes to the batcher
+        """
+        self._stopped.set()
+        for source in self.sources:
+            source.close()
+        self._thread.join(timeout=10)
+        self.batcher.close()
+
+    def _consume(self):
+        for source in self.sources:
+            try:
+                for event, file_name in source.changes():
+                    self.batcher.add(file_name)
+                return
+            except Exception as e:
+                if self._stopped.is_set():
+                    return
+                print(f"The change feed source {type(source).__name__} failed: {e}")
@@ -0,0 +1,149 @@
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+from dataprocessing.minioConnect import MyMinio
+from dataprocessing.utils.helpers import chunked
+
+
+def make_thumbnail(content: bytes, size: int, quality: int):
+    """
+    Decodes an image and resizes it to fit in a square of 'size' pixels, keeping its aspect ratio.
+    Runs in the worker processes of 'ImageDerivatives', so it only takes and returns plain values.
+    :param content: the contents of the image file
+    :param size: the maximum width and height of the thumbnail
+    :param quality: the JPEG quality of the thumbnail
+    :return: (width, height, thumbnail) -> the size of the original image and the thumbnail as JPEG bytes,
+    or (None, None, error) if the image cannot be decoded
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            width, height = image.size
+            # let the JPEG decoder downscale while decoding, which is much faster for large photos
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        return None, None, str(e) or type(e).__name__
+
+    return width, height, buffer.getvalue()
+
+
+class ImageDerivatives:
+
+    def __init__(self, minioClient: MyMinio, pg_instance, src_data_path: str, bucket_name: str = 'derivatives',
+                 table_name: str = 'image_derivatives', thumbnail_size: int = 128, quality: int = 85,
+                 processes: int = None, io_concurrency: int = 16, chunk_size: int = 256):
+        """
+        Generates the thumbnails of the images of the users in 'bucket_name' and records the width, the height
+        and the size of the images in the 'table_name' table, see 'MyPgConnect.create_table_image_derivatives'.
+        The images are decoded and resized in a pool of processes, while their downloads and the uploads of
+        the thumbnails run in threads. The derivatives of an image are only generated again when its etag changes.
+        :param minioClient: the minio client
+        :param pg_instance: the postgres client
+        :param src_data_path: the bucket of the images
+        :param bucket_name: the bucket of the thumbnails, created if needed
+        :param table_name: the name of the derivatives table
+        :param thumbnail_size: the maximum width and height of the thumbnails
+        :param quality: the JPEG quality of the thumbnails
+        :param processes: the number of processes that decode the images, the number of CPUs by default
+        :param io_concurrency: the maximum number of images downloaded or thumbnails uploaded at the same time
+        :param chunk_size: the number of images held in memory at a time
+        """
+        self.minioClient = minioClient
+        self.pg_instance = pg_instance
+        self.src_data_path = src_data_path
+        self.bucket_name = bucket_name
+        self.table_name = table_name
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self.processes = processes
+        self.io_concurrency = io_concurrency
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def thumbnail_name(user_id: str):
+        return f"thumbnails/{user_id}.jpg"
+
+    def update(self, images: dict, progress=None):
+        """
+        Generates the derivatives of new or changed images
+        :param images: the images of the format {user_id: (file_name, etag, size)} where 'file_name' is
+        the name of the image in 'self.src_data_path', e.g. the image files of 'MyMinio.get_files_info'
+        :param progress: the progress callback of 'DataProcessing.process_data'
+        :return: a summary of the format {generated, unchanged, failed}
+        """
+        recorded = self.pg_instance.get_image_derivatives(self.table_name, list(images))
+        changed = sorted(user_id for user_id, (_, etag, _) in images.items()
+                         if user_id not in recorded or recorded[user_id][0] != etag)
+        summary = {'generated': 0, 'unchanged': len(images) - len(changed), 'failed': 0}
+        if len(changed) == 0:
+            return summary
+
+        self.minioClient.create_bucket(self.bucket_name)
+
+        failed = []
+
+        # the processes are spawned, not forked from this multithreaded process with its open connections
+        with ThreadPoolExecutor(max_workers=self.io_concurrency) as threads, \
+                ProcessPoolExecutor(max_workers=self.processes,
+                                    mp_context=multiprocessing.get_context('spawn')) as processes:
+            for chunk in chunked(changed, self.chunk_size):
+                contents = list(threads.map(
+                    lambda user_id: self.minioClient.read_file_from_minio(self.src_data_path, images[user_id][0]),
+                    chunk))
+                thumbnails = dict(zip(chunk, processes.map(make_thumbnail, contents,
+                                                           [self.thumbnail_size] * len(chunk),
+                                                           [self.quality] * len(chunk))))
+
+                derivatives = {}
+                for user_id, (width, height, thumbnail) in thumbnails.items():
+                    if width is None:
+                        print(f"Failed to make the thumbnail of {images[user_id][0]}: {thumbnail}")
+                        failed.append(user_id)
+                        continue
+                    _, etag, size = images[user_id]
+                    derivatives[user_id] = (etag, width, height, size,
+                                            f"{self.bucket_name}/{self.thumbnail_name(user_id)}")
+
+                list(threads.map(lambda user_id: self.minioClient.write_file(
+                    self.bucket_name, self.thumbnail_name(user_id), thumbnails[user_id][2],
+                    content_type='image/jpeg'), derivatives))
+                self.pg_instance.update_image_derivatives(self.table_name, derivatives)
+
+                summary['generated'] += len(derivatives)
+                if progress is not None:
+                    progress('derivatives', summary['generated'] + len(failed), len(changed))
+
+        # the derivatives of the previous version of an image that cannot be decoded are out of date
+        if failed:
+            self.remove(failed)
+        summary['failed'] = len(failed)
+
+        return summary
+
+    def remove(self, user_ids: list):
+        """
+        Removes the derivatives of the images of some users, e.g. once their images are removed
+        :param user_ids: the ids of the users
+        """
+        recorded = self.pg_instance.get_image_derivatives(self.table_name, user_ids)
+        if len(recorded) == 0:
+            return
+
+        self.pg_instance.delete_rows_by_ids(self.table_name, list(recorded))
+        self.minioClient.remove_files(self.bucket_name, [self.thumbnail_name(user_id) for user_id in recorded])
+
+    def get_thumbnails(self, user_ids: list):
+        """
+        :param user_ids: the ids of the users
+        :return: the paths of the thumbnails of the users that have one, of the format {user_id: thumbnail_path}
+        """
+        return {user_id: info[4] for user_id, info in
+                self.pg_instance.get_image_derivatives(self.table_name, user_ids).items()}
@@ -0,0 +1,156 @@
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class IngestJobs:
+
+    def __init__(self, run, history_size: int = 100):
+        """
+        Runs the data processing as background jobs, one at a time, in a dedicated thread.
+        Triggers that arrive while a job is waiting to start are coalesced into that job, so at
+        most one job is running and at most one job is waiting at any time.
+        :param run: the function that processes the data. It is called as run(progress=callback) for a full run,
+        or as run(progress=callback, keys=file_names) for a run restricted to some changed files.
+        Its return value is stored as the result of the job
+        :param history_size: the number of finished jobs that are kept to be queried
+        """
+        self.run = run
+        self.history_size = history_size
+
+        self._jobs = OrderedDict()
+        self._pending = None
+        self._condition = threading.Condition()
+        self._worker = None
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.utcnow().isoformat() + 'Z'
+
+    def submit(self, trigger: str, keys=None):
+        """
+        Requests a run of the data processing
+        :param trigger: what requested the run, e.g. 'api' or 'scheduler'
+        :param keys: if specified, the names of the changed files the run can be restricted to. The keys of
+        coalesced requests are merged, and a request without keys turns the job into a full run.
+        :return: a copy of the job that will handle the request
+        """
+        with self._condition:
+            if self._pending is None:
+                job_id = uuid.uuid4().hex
+                self._jobs[job_id] = {
+                    'id': job_id,
+                    'status': 'queued',
+                    'triggers': [],
+                    'keys': set(),
+                    'created_at': self._now(),
+                    'started_at': None,
+                    'finished_at': None,
+                    'duration': None,
+                    'stage': None,
+                    'progress': None,
+                    'stages': {},
+                    'result': None,
+                    'error': None,
+                }
+                self._pending = job_id
+                self._forget_old_jobs()
+
+            job = self._jobs[self._pending]
+            job['triggers'].append(trigger)
+            if keys is None:
+                job['keys'] = None
+            elif job['keys'] is not None:
+                job['keys'].update(keys)
+
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='ingest-jobs', daemon=True)
+                self._worker.start()
+            self._condition.notify()
+
+            return self._copy(job)
+
+    def get(self, job_id: str):
+        """
+        Gets the status of a job
+        :param job_id: the id of the job
+        :return: a copy of the job, or None if it does not exist
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return self._copy(job) if job is not None else None
+
+    def active(self):
+        """
+        :return: True if a job is running or waiting to start
+        """
+        with self._condition:
+            return any(job['status'] in ('queued', 'running') for job in self._jobs.values())
+
+    def recent(self):
+        """
+        :return: copies of the known jobs, the most recent first
+        """
+        with self._condition:
+            return [self._copy(job) for job in reversed(self._jobs.values())]
+
+    @staticmethod
+    def _copy(job: dict):
+        job = dict(job)
+        job['triggers'] = list(job['triggers'])
+        job['stages'] = dict(job['stages'])
+        job['keys'] = len(job['keys']) if job['keys'] is not None else None
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('succeeded', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.history_size)]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                job = self._jobs[self._pending]
+                self._pending = None
+
+                job['status'] = 'running'
+                job['started_at'] = self._now()
+
+            self._run_job(job)
+
+    def _run_job(self, job: dict):
+        started = time.monotonic()
+        stage_started = [started]
+
+        def progress(stage: str, done: int = None, total: int = None):
+            now = time.monotonic()
+            with self._condition:
+                if job['stage'] is not None and job['stage'] != stage:
+                    job['stages'][job['stage']] = round(now - stage_started[0], 3)
+                    stage_started[0] = now
+                job['stage'] = stage
+                job['progress'] = {'done': done, 'total': total}
+
+        try:
+            if job['keys'] is None:
+                result = self.run(progress=progress)
+            else:
+                result = self.run(progress=progress, keys=sorted(job['keys']))
+            status, error = 'succeeded', None
+        except Exception as e:
+            print(e)
+            result, status, error = None, 'failed', str(e) or type(e).__name__
+
+        now = time.monotonic()
+        with self._condition:
+            if job['stage'] is not None:
+                job['stages'][job['stage']] = round(now - stage_started[0], 3)
+            job['status'] = status
+            job['result'] = result
+            job['error'] = error
+            job['finished_at'] = self._now()
+            job['duration'] = round(now - started, 3)
@@ -1,9 +1,22 @@
 import csv
+import datetime
+import io
+import itertools
+import json
 import os
-from dataprocessing.utils.helpers import dict_to_list, millis_to_age, make_2d_list, test_files_validity
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataprocessing.utils.helpers import dict_to_list, file_to_user_id, dict_to_db_row, age_to_millis, chunked, \
+    validate_header, validate_user_row, parse_user_file, user_shard, InvalidFileError, NO_IMAGE
 from dataprocessing.minioConnect import MyMinio
 from minio.error import S3Error
 from dataprocessing.postgresConnect import MyPgConnect
+from dataprocessing.parquetOutput import ParquetOutput
+from dataprocessing.readModel import UsersReadModel
+from dataprocessing.imageDerivatives import ImageDerivatives
+from dataprocessing.responseEncoding import rows_to_columns
+from dataprocessing import metrics
 from decouple import config
 
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", config("MINIO_ACCESS_KEY"))
@@ -14,51 +27,277 @@ POSTGRES_USER = os.getenv("POSTGRES_USER", config("POSTGRES_USER"))
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", config("POSTGRES_PASSWORD"))
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", config("POSTGRES_HOST"))
 
+PG_POOL_MIN_SIZE = config("PG_POOL_MIN_SIZE", default=2, cast=int)
+PG_POOL_MAX_SIZE = config("PG_POOL_MAX_SIZE", default=10, cast=int)
+PG_POOL_HEALTH_CHECK_INTERVAL = config("PG_POOL_HEALTH_CHECK_INTERVAL", default=30, cast=float)
+
+# The number of users read from the DB and encoded at a time when streaming GET /data
+STREAM_BATCH_SIZE = config("STREAM_BATCH_SIZE", default=1000, cast=int)
+
+# Answer GET /data from the in-memory columnar copy of the users instead of postgres
+READ_MODEL = config("READ_MODEL", default=True, cast=bool)
+
+# Only process the source files that are new or changed since the last run
+INCREMENTAL_PROCESSING = config("INCREMENTAL_PROCESSING", default=True, cast=bool)
+
+# The maximum number of source files that are downloaded at the same time
+FETCH_CONCURRENCY = config("FETCH_CONCURRENCY", default=16, cast=int)
+
+# The csv files under this prefix of 'srcdata' contain many users each, with the columns
+# user_id, first_name, last_name, birthts. They are processed BULK_CHUNK_SIZE users at a time.
+BULK_PREFIX = config("BULK_PREFIX", default='bulk/')
+BULK_CHUNK_SIZE = config("BULK_CHUNK_SIZE", default=10000, cast=int)
+BULK_COLUMNS = ['user_id', 'first_name', 'last_name', 'birthts']
+# The table where the users of the older version of a bulk file are staged, see 'process_bulk_file'
+BULK_FILE_IDS_TABLE = 'bulk_file_ids'
+
+# The invalid source files are moved under this prefix of 'processeddata', and the reasons are recorded
+# in the 'quarantine' table
+QUARANTINE_PREFIX = config("QUARANTINE_PREFIX", default='quarantine/')
+
+# The format of the results in 'processeddata': 'csv' (output.csv), 'parquet' or 'both'
+OUTPUT_FORMAT = config("OUTPUT_FORMAT", default='csv')
+PARQUET_PREFIX = config("PARQUET_PREFIX", default='parquet/')
+PARQUET_COMPRESSION = config("PARQUET_COMPRESSION", default='zstd')
+# The small parquet files are merged once there are at least PARQUET_COMPACT_MIN_FILES of them
+PARQUET_COMPACT_MIN_FILES = config("PARQUET_COMPACT_MIN_FILES", default=10, cast=int)
+PARQUET_COMPACT_MAX_SIZE = config("PARQUET_COMPACT_MAX_SIZE", default=64 * 1024 ** 2, cast=int)
+
+# The number of shards the csv results are split into by the hash of the user_id,
+# 0 to write all the users to the single file output.csv
+OUTPUT_SHARDS = config("OUTPUT_SHARDS", default=0, cast=int)
+SHARDS_PREFIX = 'shards/'
+# The maximum number of shards that are rewritten at the same time
+SHARD_WRITE_CONCURRENCY = config("SHARD_WRITE_CONCURRENCY", default=8, cast=int)
+
+# Generate the thumbnails of the images of the users in the DERIVATIVES_BUCKET bucket
+# and record the size of the images in postgres
+IMAGE_DERIVATIVES = config("IMAGE_DERIVATIVES", default=False, cast=bool)
+DERIVATIVES_BUCKET = config("DERIVATIVES_BUCKET", default='derivatives')
+# The maximum width and height of the thumbnails
+THUMBNAIL_SIZE = config("THUMBNAIL_SIZE", default=128, cast=int)
+# The number of processes that decode the images, 0 for the number of CPUs
+IMAGE_PROCESSES = config("IMAGE_PROCESSES", default=0, cast=int)
+
 
 class DataProcessing:
 
-    def __init__(self, src_data_path: str, processed_data_path: str):
+    def __init__(self, src_data_path: str, processed_data_path: str,
+                 minio_client: MyMinio = None, pg_instance: MyPgConnect = None, shared_locks: bool = False):
         """
         Initialize the instance with the files' paths that the data processing will be applied to
         :param src_data_path: the path of the source data where the information
         will be retrieved
         :param processed_data_path: the path of the processed data where the results
         will be stored
+        :param minio_client: the minio client to use instead of connecting to MINIO_HOST,
+        e.g. the in-memory stand-in of the benchmarks
+        :param pg_instance: the postgres client to use instead of connecting to POSTGRES_HOST
+        :param shared_locks: if True, the results files are also locked in postgres while they are written,
+        for several replicas of the service that write the same results
         """
         self.src_data_path = src_data_path
         self.processed_data_path = processed_data_path
 
-        self.minioClient = MyMinio(MINIO_ACCESS_KEY, MINIO_SECRET_KEY)
-        self.pg_instance = MyPgConnect(dbname=POSTGRES_DB, user=POSTGRES_USER,
-                                       password=POSTGRES_PASSWORD, host=POSTGRES_HOST)
+        # Incremented each time a run changes the processed data
+        self.data_version = 0
+        # The watermark of the changes of the users already seen by 'sync_changes'
+        self._changes_watermark = None
+
+        # The results are written by read-modify-write, so the writers of the same file take turns
+        self._output_lock = threading.Lock()
+        self._shard_locks = [threading.Lock() for _ in range(OUTPUT_SHARDS)]
+        self.shared_locks = shared_locks
+
+        self.minioClient = minio_client or MyMinio(MINIO_ACCESS_KEY, MINIO_SECRET_KEY)
+        self.pg_instance = pg_instance or MyPgConnect(dbname=POSTGRES_DB, user=POSTGRES_USER,
+                                                      password=POSTGRES_PASSWORD, host=POSTGRES_HOST,
+                                                      min_connections=PG_POOL_MIN_SIZE,
+                                                      max_connections=PG_POOL_MAX_SIZE,
+                                                      health_check_interval=PG_POOL_HEALTH_CHECK_INTERVAL)
+        # The in-memory copy of the users, loaded from postgres on first use and updated by each run
+        self.read_model = UsersReadModel(
+            lambda: self.pg_instance.iter_users_data('users', batch_size=STREAM_BATCH_SIZE))
+
+        self.parquet_output = ParquetOutput(self.minioClient, processed_data_path, prefix=PARQUET_PREFIX,
+                                            compression=PARQUET_COMPRESSION,
+                                            compact_min_files=PARQUET_COMPACT_MIN_FILES,
+                                            compact_max_size=PARQUET_COMPACT_MAX_SIZE)
+
+        self.image_derivatives = ImageDerivatives(self.minioClient, self.pg_instance, src_data_path,
+                                                  bucket_name=DERIVATIVES_BUCKET, thumbnail_size=THUMBNAIL_SIZE,
+                                                  processes=IMAGE_PROCESSES or None,
+                                                  io_concurrency=FETCH_CONCURRENCY) if IMAGE_DERIVATIVES else None
+
+    def load_output(self, file_name: str = 'output.csv'):
+        """
+        Load the processed data of the users from a results file of 'self.processed_data_path' in memory.
+        :param file_name: the name of the results file, 'output.csv' or a shard, see 'shard_file_name'
+        :return: a dictionary of the format {user_id: [user_id, first_name, last_name, birthts, img_path]}
+        that preserves the order of the rows in the results file
+        """
+        rows = self.minioClient.iter_csv_file_from_minio(self.processed_data_path, file_name)
+        try:
+            # skip the header
+            next(rows, None)
+            return {row[0]: row for row in rows}
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                raise
+            return {}
+
+    def _write_output(self, file_name: str, rows):
+        buffer = io.StringIO()
+        csv_writer = csv.writer(buffer)
+        csv_writer.writerow(['user_id', 'first_name', 'last_name', 'birthts', 'img_path'])
+        csv_writer.writerows(rows)
+
+        self.minioClient.write_file(self.processed_data_path, file_name, buffer.getvalue().encode())
+
+    def _merge_output_file(self, file_name: str, users: list, deleted_ids: list):
+        """
+        Apply updates to a single results file: the file is read once, merged in memory and replaced with a single upload.
+        :return: the number of users in the file after the update
+        """
+        output = self.load_output(file_name)
+
+        for user_id in deleted_ids:
+            output.pop(user_id, None)
 
-    def check_id(self, user_id: str):
+        for user_data in users:
+            # overwrite the old record of the user (if any)
+            output.pop(user_data['user_id'], None)
+            output[user_data['user_id']] = dict_to_list(user_data)
+
+        self._write_output(file_name, output.values())
+
+        return len(output)
+
+    @contextmanager
+    def _output_locked(self, lock: threading.Lock, file_name: str):
         """
-        Check if the user with id 'user_id' already exist in the 'self.processed_data_path', and overwrite it.
-        :param user_id: the id of the user that we will check if it exists in the results file.
+        Hold the lock of a results file, and its postgres advisory lock with 'self.shared_locks'
         """
+        with lock:
+            if not self.shared_locks:
+                yield
+                return
+            with self.pg_instance.advisory_lock(f"{self.processed_data_path}/{file_name}"):
+                yield
+
+    def merge_output(self, users: list, deleted_ids: list):
+        """
+        Apply all the updates of a run to the results in 'self.processed_data_path' at once. With 'OUTPUT_SHARDS'
+        set, only the shards of the updated users are rewritten, see 'merge_output_shards'. Otherwise
+        the whole file output.csv is rewritten.
+        :param users: a list of dicts of the data of the users to add or overwrite.
+        Each dict has the keys: [user_id, first_name, last_name, birthts, img_path]
+        :param deleted_ids: the ids of the users to remove from the results
+        """
+        if len(users) == 0 and len(deleted_ids) == 0:
+            return
 
-        try:
-            contents = self.minioClient.read_csv_file_from_minio(self.processed_data_path, 'output.csv')
-            rows = make_2d_list(contents, 5)
-        except S3Error:
+        if OUTPUT_SHARDS > 0:
+            self.merge_output_shards(users, deleted_ids)
             return
 
-        to_write = [row for row in rows if row[0] != user_id]
+        with self._output_locked(self._output_lock, 'output.csv'):
+            self._merge_output_file('output.csv', users, deleted_ids)
+
+    @staticmethod
+    def shard_file_name(shard: int):
+        return f"{SHARDS_PREFIX}shard-{shard:04d}.csv"
 
-        write_obj = open("temp.csv", 'w+')
-        csv.writer(write_obj).writerows(to_write)
+    def load_shard_index(self):
+        """
+        Load the index of the sharded results from 'self.processed_data_path'
+        :return: the index of the format {shards, hash, files, users} where 'files' and 'users' are the name
+        and the number of users of each shard, or None if the results are not sharded yet
+        """
+        try:
+            return json.loads(self.minioClient.read_file_from_minio(self.processed_data_path,
+                                                                    f"{SHARDS_PREFIX}index.json"))
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                raise
+            return None
+
+    def _write_shard_index(self, users: list):
+        index = {
+            'shards': len(users),
+            'hash': 'crc32',
+            'files': [self.shard_file_name(shard) for shard in range(len(users))],
+            'users': users,
+        }
+        self.minioClient.write_file(self.processed_data_path, f"{SHARDS_PREFIX}index.json",
+                                    json.dumps(index).encode())
 
-        write_obj.close()
+    def _init_shards(self):
+        """
+        Create the shards and their index, moving the users of output.csv (if any) to their shards,
+        and then remove output.csv so that its stale users are not read as the results.
+        Must be called with the lock of the index held.
+        """
+        shards = [[] for _ in range(OUTPUT_SHARDS)]
+        for user_id, row in self.load_output().items():
+            shards[user_shard(user_id, OUTPUT_SHARDS)].append(row)
 
-        self.minioClient.minioClient.remove_object(self.processed_data_path, 'output.csv')
-        self.minioClient.minioClient.fput_object(self.processed_data_path, 'output.csv', 'temp.csv')
-        os.remove('temp.csv')
+        with ThreadPoolExecutor(max_workers=SHARD_WRITE_CONCURRENCY) as executor:
+            list(executor.map(lambda shard: self._write_output(self.shard_file_name(shard), shards[shard]),
+                              range(OUTPUT_SHARDS)))
+
+        self._write_shard_index([len(rows) for rows in shards])
+        # only once the index is written, the shards would be initialized again without it
+        self.minioClient.remove_files(self.processed_data_path, ['output.csv'])
+
+    def merge_output_shards(self, users: list, deleted_ids: list):
+        """
+        Apply the updates of a run to the results split into 'OUTPUT_SHARDS' shards by the hash of the user_id.
+        Only the shards that contain updated users are rewritten, in parallel, and the writers of different
+        shards do not wait for each other. The index is updated once the shards are written.
+        :param users: the users to add or overwrite, see 'merge_output'
+        :param deleted_ids: the ids of the users to remove from the results
+        """
+        with self._output_locked(self._output_lock, f"{SHARDS_PREFIX}index.json"):
+            index = self.load_shard_index()
+            if index is None:
+                self._init_shards()
+            elif index['shards'] != OUTPUT_SHARDS:
+                raise ValueError(f"The results are split into {index['shards']} shards, "
+                                 f"but OUTPUT_SHARDS is {OUTPUT_SHARDS}")
+
+        changes = {}
+        for user_info in users:
+            changes.setdefault(user_shard(user_info['user_id'], OUTPUT_SHARDS), ([], []))[0].append(user_info)
+        for user_id in deleted_ids:
+            changes.setdefault(user_shard(user_id, OUTPUT_SHARDS), ([], []))[1].append(user_id)
+
+        def merge_shard(shard: int):
+            with self._output_locked(self._shard_locks[shard], self.shard_file_name(shard)):
+                return shard, self._merge_output_file(self.shard_file_name(shard), *changes[shard])
+
+        with ThreadPoolExecutor(max_workers=SHARD_WRITE_CONCURRENCY) as executor:
+            counts = dict(executor.map(merge_shard, sorted(changes)))
+
+        with self._output_locked(self._output_lock, f"{SHARDS_PREFIX}index.json"):
+            shard_users = self.load_shard_index()['users']
+            for shard, count in counts.items():
+                shard_users[shard] = count
+            self._write_shard_index(shard_users)
+
+    def check_id(self, user_id: str):
+        """
+        Check if the user with id 'user_id' already exist in the 'self.processed_data_path', and remove it.
+        :param user_id: the id of the user that we will check if it exists in the results file.
+        """
+        self.merge_output([], [user_id])
 
-    def get_data(self, **filters):
+    def get_data(self, thumbnails: bool = False, **filters):
         """
         Retrieves the users' processed data from 'self.processed_data_path' path after applying
         the given 'filters'.
+        :param thumbnails: if True, the path of the thumbnail of the image of each user is added as 'thumbnail_path'
+        (None if the user has no thumbnail), see 'ImageDerivatives'
         :param filters: a dictionary that contains the filters to apply to the data.
         Possible keys for 'filters':
         'is_image_exists' which specifies if the users must have an image or not
@@ -81,118 +320,619 @@ class DataProcessing:
         }
         """
 
-        data = self.pg_instance.get_users_data('users')
-        data = make_2d_list(data, 5)
+        if READ_MODEL:
+            data = self.read_model.get_users_data(**self._users_filters(filters))
+        else:
+            data = self.pg_instance.get_users_data('users', **self._users_filters(filters))
 
-        if filters['is_image_exists'] != -1:
-            if filters['is_image_exists'] == 'true':
-                data = [row for row in data if row[4] != "No image found"]
-            elif filters['is_image_exists'] == 'false':
-                data = [row for row in data if row[4] == "No image found"]
+        final_data = {row[0]: self._row_to_user(row) for row in data}
+        if thumbnails:
+            self._add_thumbnails(final_data)
 
-        if filters['min_age'] != -1:
-            minimum_age = float(filters['min_age'])
-            data = [row for row in data if float(millis_to_age(float(row[3]))) >= minimum_age]
+        return final_data
 
-        if filters['max_age'] != -1:
-            maximum_age = float(filters['max_age'])
-            data = [row for row in data if float(millis_to_age(float(row[3]))) <= maximum_age]
+    def get_data_page(self, limit: int, after: str = None, thumbnails: bool = False, **filters):
+        """
+        Same as 'get_data', but retrieves at most 'limit' users ordered by user_id, starting after
+        the user with id 'after'.
+        :param limit: the maximum number of users in the page
+        :param after: the cursor returned with the previous page, if any
+        :param thumbnails: if True, add the paths of the thumbnails, see 'get_data'
+        :param filters: the same filters as 'get_data'
+        :return: the page in JSON format:
+        {
+            data: {
+                user_id1: {...},
+                ...
+            },
+            next_cursor: the value of 'after' to get the next page, or None if this is the last page
+        }
+        """
+        # read one more user to know if there is a next page
+        data = self.pg_instance.get_users_data('users', after=after, limit=limit + 1, **self._users_filters(filters))
+
+        next_cursor = data[limit - 1][0] if len(data) > limit else None
 
-        final_data = {
-            row[0]: {
-                'first_name': row[1],
-                'last_name': row[2],
-                'birthts': row[3],
-                'img_path': row[4],
-            } for row in data
+        page = {row[0]: self._row_to_user(row) for row in data[:limit]}
+        if thumbnails:
+            self._add_thumbnails(page)
+
+        return {
+            'data': page,
+            'next_cursor': next_cursor
         }
 
-        return final_data
+    def get_data_columns(self, limit: int = None, after: str = None, thumbnails: bool = False, **filters):
+        """
+        Same as 'get_data', or 'get_data_page' if 'limit' is specified, but the users are returned as columns
+        straight from the rows of the DB or from the in-memory copy of the users, without a dict per user,
+        for the columnar representations of 'responseEncoding'
+        :param limit: if specified, the maximum number of users, see 'get_data_page'
+        :param after: the cursor returned with the previous page, if any
+        :param thumbnails: if True, the column 'thumbnail_path' is added, see 'get_data'
+        :param filters: the same filters as 'get_data'
+        :return: (columns, next_cursor) -> the columns of the format {user_id: [...], first_name: [...],
+        last_name: [...], birthts: [...], img_path: [...]} where birthts are integers and img_path is None
+        for the users that do not have an image, and the cursor of the next page (None if this is the last page)
+        """
+        next_cursor = None
+        if limit is None and READ_MODEL:
+            columns = self.read_model.get_users_columns(**self._users_filters(filters))
+        elif limit is None:
+            columns = rows_to_columns(self.pg_instance.get_users_data('users', **self._users_filters(filters)))
+        else:
+            # read one more user to know if there is a next page
+            rows = self.pg_instance.get_users_data('users', after=after, limit=limit + 1,
+                                                   **self._users_filters(filters))
+            next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+            columns = rows_to_columns(rows[:limit])
+
+        if thumbnails:
+            paths = self._thumbnail_paths([user_id for user_id, img_path in zip(columns['user_id'], columns['img_path'])
+                                           if img_path is not None])
+            columns['thumbnail_path'] = [paths.get(user_id) for user_id in columns['user_id']]
+
+        return columns, next_cursor
+
+    def get_changes(self, since: int, thumbnails: bool = False):
+        """
+        Retrieves the users that were added, changed or deleted since a watermark, so a copy of the users
+        can be kept up to date without reading all of them again
+        :param since: the watermark returned by the previous call, 0 to get all the users
+        :param thumbnails: if True, add the paths of the thumbnails, see 'get_data'
+        :return: the changes in JSON format:
+        {
+            data: {
+                user_id1: {...},
+                ...
+            },
+            deleted: the ids of the deleted users,
+            watermark: the value of 'since' to get the next changes
+        }
+        """
+        rows, deleted_ids, watermark = self.pg_instance.get_users_changes('users', since)
+
+        data = {row[0]: self._row_to_user(row) for row in rows}
+        if thumbnails:
+            self._add_thumbnails(data)
+
+        return {
+            'data': data,
+            'deleted': deleted_ids,
+            'watermark': watermark
+        }
 
-    def get_files(self):
+    def sync_changes(self):
         """
-        Get the names of the csv and image files from the 'self.src_data_path' path
-        :return: two lists of files' paths and names of the format (csv_files, image_files)
-        csv_files format: [(file_path, file_name)]
-        image_files format: [(file_path, file_name)]
+        Applies the changes of the users written by other processes, e.g. the other replicas of the service or
+        'backfill.py', to the in-memory copy of the users, and bumps 'data_version' if there are any, so the cached
+        responses are invalidated. The changes are read since the watermark of the previous call, see
+        'MyPgConnect.get_users_changes', so the changes of this process are read again, which does no harm.
+        The first call reloads the in-memory copy of the users, if 'READ_MODEL' is set.
+        :return: the number of changed or deleted users
         """
+        if self._changes_watermark is None:
+            self._changes_watermark = self.pg_instance.get_changes_watermark()
+            if READ_MODEL:
+                self.read_model.reload()
+            self.data_version += 1
+            return 0
+
+        rows, deleted_ids, self._changes_watermark = self.pg_instance.get_users_changes('users',
+                                                                                       self._changes_watermark)
+        if rows or deleted_ids:
+            self.read_model.apply(rows, deleted_ids)
+            self.data_version += 1
+        return len(rows) + len(deleted_ids)
+
+    def _thumbnail_paths(self, user_ids: list):
+        """
+        Get the paths of the thumbnails of users that have an image, see 'ImageDerivatives.get_thumbnails'
+        """
+        if self.image_derivatives is None or len(user_ids) == 0:
+            return {}
+        return self.image_derivatives.get_thumbnails(user_ids)
 
-        files = self.minioClient.get_files_in_bucket(self.src_data_path)
+    def _add_thumbnails(self, users: dict):
+        """
+        Add the path of the thumbnail of each user to the data of the users returned by 'get_data'
+        """
+        paths = self._thumbnail_paths([user_id for user_id, user in users.items() if user['img_path'] != NO_IMAGE])
 
-        csv_files = [(file, file[:file.find('.')])
-                     for file in files if file.endswith('.csv')]
+        for user_id, user in users.items():
+            user['thumbnail_path'] = paths.get(user_id)
 
-        image_files = [(f"{self.src_data_path}/{file}", file[:file.find('.')])
-                       for file in files if not file.endswith('.csv')]
+    def get_stats(self, age_bin: float = 10, **filters):
+        """
+        Computes the aggregates of the users that match the given 'filters' from the in-memory copy of the users,
+        without querying postgres.
+        :param age_bin: the width in years of the bins of the age histogram
+        :param filters: the same filters as 'get_data'
+        :return: the aggregates, see 'UsersReadModel.get_stats'
+        """
+        return self.read_model.get_stats(age_bin=age_bin, **self._users_filters(filters))
+
+    def stream_data(self, output_format: str = 'json', **filters):
+        """
+        Same as 'get_data', but the users are read from the DB and encoded as they arrive,
+        so the whole table can be exported in constant memory.
+        :param output_format: 'json' to produce the same object as 'get_data', or 'ndjson' to produce
+        one object per line of the format {user_id, first_name, last_name, birthts, img_path}
+        :param filters: the same filters as 'get_data'
+        :return: a generator of the chunks of the encoded data
+        """
+        rows = self.pg_instance.iter_users_data('users', batch_size=STREAM_BATCH_SIZE, **self._users_filters(filters))
+
+        chunk = [] if output_format == 'ndjson' else ['{']
+        count = 0
+
+        for row in rows:
+            user = self._row_to_user(row)
+
+            if output_format == 'ndjson':
+                chunk.append(json.dumps(dict(user_id=row[0], **user)) + '\n')
+            else:
+                chunk.append((', ' if count > 0 else '') + json.dumps(row[0]) + ': ' + json.dumps(user))
+            count += 1
+
+            if count % STREAM_BATCH_SIZE == 0:
+                yield ''.join(chunk)
+                chunk = []
+
+        if output_format != 'ndjson':
+            chunk.append('}')
+        yield ''.join(chunk)
+
+    @staticmethod
+    def _users_filters(filters: dict):
+        """
+        Transform the filters of 'get_data' to the filters of 'MyPgConnect.get_users_data'
+        """
+        has_image = {'true': True, 'false': False}.get(filters['is_image_exists'])
+
+        # the older a user is, the smaller the birth timestamp is
+        max_birthts = age_to_millis(float(filters['min_age'])) if filters['min_age'] != -1 else None
+        min_birthts = age_to_millis(float(filters['max_age'])) if filters['max_age'] != -1 else None
+
+        return {'has_image': has_image, 'min_birthts': min_birthts, 'max_birthts': max_birthts}
+
+    @staticmethod
+    def _row_to_user(row):
+        """
+        Transform a row of the 'users' table to the data of the user returned by 'get_data'
+        """
+        return {
+            'first_name': row[1],
+            'last_name': row[2],
+            'birthts': str(row[3]),
+            'img_path': row[4] if row[4] is not None else NO_IMAGE,
+        }
+
+    def get_files(self, files_info: dict):
+        """
+        Index the csv and image files from the 'self.src_data_path' path by the id of the user
+        :param files_info: the files inside 'self.src_data_path' as returned by 'MyMinio.get_files_info'
+        :return: two dictionaries of the format (csv_files, image_files)
+        csv_files format: {user_id: file_name}
+        image_files format: {user_id: file_path}
+        """
+
+        csv_files = {file_to_user_id(file): file
+                     for file in files_info if file.endswith('.csv') and not self.is_bulk_file(file)}
+
+        image_files = {file_to_user_id(file): f"{self.src_data_path}/{file}"
+                       for file in files_info if not file.endswith('.csv') and not self.is_bulk_file(file)}
 
         return csv_files, image_files
 
-    def add_data(self, user_data: dict):
+    @staticmethod
+    def plan_changes(files_info: dict, manifest: dict):
         """
-        Add the data of a user to 'processed_data_path' file.
+        Compare the files inside 'self.src_data_path' with the files recorded in the manifest
+        of the previous runs.
+        :param files_info: the current files of the format {file_name: (etag, size, last_modified)}
+        :param manifest: the already processed files of the same format as 'files_info'
+        :return: (changed_files, removed_files) -> a dictionary of the new or changed files of the same
+        format as 'files_info' and a list of the names of the files that do not exist anymore
+        """
+        changed_files = {file: info for file, info in files_info.items()
+                         if file not in manifest or tuple(manifest[file][:2]) != tuple(info[:2])}
 
-        :param user_data: a dict of the data of the user.
-        'user_data' keys are: [user_id, first_name, last_name, birthts, img_path]
+        removed_files = [file for file in manifest if file not in files_info]
+
+        return changed_files, removed_files
+
+    @staticmethod
+    def is_bulk_file(file_name: str):
+        """
+        Check if a source file contains many users, see 'process_bulk_file'
         """
-        self.check_id(user_data['user_id'])
+        return file_name.startswith(BULK_PREFIX)
 
-        try:
-            contents = self.minioClient.read_csv_file_from_minio(self.processed_data_path, 'output.csv')
-            to_write = make_2d_list(contents, 5)
-        except S3Error:
-            to_write = []
+    def process_bulk_file(self, file_name: str, image_files: dict, progress=None, batch_id: str = None):
+        """
+        Process a source csv file that contains many users. The file is streamed and goes through the validation,
+        the image matching and the upsert into the DB 'BULK_CHUNK_SIZE' users at a time, so the memory used
+        does not depend on the size of the file. Each chunk of the results is written as its own part file
+        '<file_name>/part-<n>.csv' in 'self.processed_data_path', replacing the parts of an older version of the file.
+        Invalid rows are skipped, and an 'InvalidFileError' is raised if the file does not have the expected columns.
+        The users of the older version of the file that are not in the new one are deleted, found through the
+        'BULK_FILE_IDS_TABLE' table, and removing the whole file deletes its users, see 'remove_bulk_file'.
+        :param file_name: the name of the file in 'self.src_data_path'
+        :param image_files: the image files indexed by the id of the user, as returned by 'get_files'
+        :param progress: the progress callback of 'process_data'
+        :param batch_id: the id of the parquet batch of the run, if the results are also written as parquet files.
+        Each chunk is then written as its own file of the batch, see 'ParquetOutput.write_batch'
+        :return: a summary of the format {users, inserted, updated, deleted, invalid}
+        """
+        summary = {'users': 0, 'inserted': 0, 'updated': 0, 'deleted': 0, 'invalid': 0}
+
+        # the users of the older version of the file are staged in postgres one part at a time, before its parts
+        # are replaced, and the users of each chunk of the new version are unstaged. The ids left over by
+        # an interrupted run of the same file are kept, they were not in the new version either.
+        old_parts = self.minioClient.get_files_in_bucket_with_prefix(self.processed_data_path, f"{file_name}/")
+        for part_name in old_parts:
+            self.pg_instance.stage_bulk_file_ids(BULK_FILE_IDS_TABLE, file_name, self._read_part_ids(part_name))
+
+        rows = self.minioClient.iter_csv_file_from_minio(self.src_data_path, file_name)
+        columns = next(rows, [])
+        reason = validate_header(columns, BULK_COLUMNS)
+        if reason is not None:
+            raise InvalidFileError(reason)
+        index = {column: i for i, column in enumerate(columns)}
+
+        new_parts = []
+        for part, chunk in enumerate(chunked(rows, BULK_CHUNK_SIZE)):
+            users = []
+            for row in chunk:
+                if validate_user_row(row, columns) is not None:
+                    summary['invalid'] += 1
+                    continue
+
+                user_id = row[index['user_id']]
+                users.append({
+                    'user_id': user_id,
+                    'first_name': row[index['first_name']],
+                    'last_name': row[index['last_name']],
+                    'birthts': int(row[index['birthts']]),
+                    'img_path': image_files.get(user_id, NO_IMAGE)
+                })
+
+            buffer = io.StringIO()
+            csv_writer = csv.writer(buffer)
+            csv_writer.writerow(['user_id', 'first_name', 'last_name', 'birthts', 'img_path'])
+            csv_writer.writerows(dict_to_list(user_info) for user_info in users)
+
+            part_name = f"{file_name}/part-{part:05d}.csv"
+            self.minioClient.write_file(self.processed_data_path, part_name, buffer.getvalue().encode())
+            new_parts.append(part_name)
+
+            if batch_id is not None:
+                self.parquet_output.write_batch(batch_id, users, [],
+                                                part_name=f"{file_name.replace('/', '_')}-part-{part:05d}")
+
+            self.pg_instance.unstage_bulk_file_ids(BULK_FILE_IDS_TABLE, file_name,
+                                                   [user_info['user_id'] for user_info in users])
+
+            rows = [dict_to_db_row(user_info) for user_info in users]
+            inserted, updated = self.pg_instance.insert_users('users', [item for row in rows for item in row])
+            self.read_model.apply(rows, [])
+
+            summary['users'] += len(users)
+            summary['inserted'] += inserted
+            summary['updated'] += updated
+            if progress is not None:
+                progress('bulk', summary['users'], None)
+
+        stale_parts = [part_name for part_name in old_parts if part_name not in new_parts]
+        if stale_parts:
+            self.minioClient.remove_files(self.processed_data_path, stale_parts)
+
+        # the users that were removed from the file are the ones still staged
+        for part in itertools.count():
+            ids = self.pg_instance.pop_bulk_file_ids(BULK_FILE_IDS_TABLE, file_name, BULK_CHUNK_SIZE)
+            if not ids:
+                break
+            self.pg_instance.delete_users('users', ids)
+            self.read_model.apply([], ids)
+            if batch_id is not None:
+                self.parquet_output.write_batch(batch_id, [], ids,
+                                                part_name=f"{file_name.replace('/', '_')}-dropped-{part:05d}")
+            summary['deleted'] += len(ids)
+
+        return summary
+
+    def _read_part_ids(self, part_name: str):
+        """
+        Read the ids of the users of a part file of the results of a bulk file, see 'process_bulk_file'
+        """
+        rows = self.minioClient.iter_csv_file_from_minio(self.processed_data_path, part_name)
+        # skip the header
+        next(rows, None)
+        return [row[0] for row in rows]
 
-        with open('temp.csv', 'w+') as writefile:
-            csv_writer = csv.writer(writefile)
+    def remove_bulk_file(self, file_name: str, batch_id: str = None):
+        """
+        Delete the users of a removed source file that contained many users, reading their ids back from
+        the part files of the results, one part at a time, and then remove the part files.
+        :param file_name: the name of the removed file in 'self.src_data_path'
+        :param batch_id: the id of the parquet batch of the run, if the deletions are also written as parquet files
+        :return: the number of deleted users
+        """
+        parts = self.minioClient.get_files_in_bucket_with_prefix(self.processed_data_path, f"{file_name}/")
 
-            if len(to_write) == 0:
-                csv_writer.writerow(['user_id', 'first_name', 'last_name', 'birthts', 'img_path'])
+        deleted = 0
+        for part, part_name in enumerate(parts):
+            ids = self._read_part_ids(part_name)
+            if ids:
+                self.pg_instance.delete_users('users', ids)
+                self.read_model.apply([], ids)
+            if batch_id is not None:
+                self.parquet_output.write_batch(batch_id, [], ids,
+                                                part_name=f"{file_name.replace('/', '_')}-deleted-{part:05d}")
+            deleted += len(ids)
 
-            user_data = dict_to_list(user_data)
-            to_write.append(user_data)
+        if parts:
+            self.minioClient.remove_files(self.processed_data_path, parts)
 
-            csv_writer.writerows(to_write)
+        return deleted
 
-            writefile.close()
+    def update_derivatives(self, changed_files: dict, removed_files: list, progress=None):
+        """
+        Generate the derivatives of the new or changed images of a run, and remove the derivatives
+        of the removed images, see 'ImageDerivatives'
+        :param changed_files: the new or changed files of the run, as returned by 'plan_changes'
+        :param removed_files: the removed files of the run
+        :param progress: the progress callback of 'process_data'
+        :return: the number of generated thumbnails
+        """
+        images = {file_to_user_id(file): (file, etag, size)
+                  for file, (etag, size, _) in changed_files.items() if not file.endswith('.csv')}
+        # an image can be replaced by an image of another type, e.g. '1000.png' by '1000.jpg'
+        removed_ids = {file_to_user_id(file) for file in removed_files if not file.endswith('.csv')} - set(images)
 
-            self.minioClient.minioClient.remove_object(self.processed_data_path, 'output.csv')
-            self.minioClient.minioClient.fput_object(self.processed_data_path, 'output.csv', 'temp.csv')
-            os.remove('temp.csv')
+        if removed_ids:
+            self.image_derivatives.remove(sorted(removed_ids))
+        return self.image_derivatives.update(images, progress)['generated']
 
-    def process_data(self):
+    def quarantine_files(self, files: dict, files_info: dict):
         """
-        Process the data from 'self.src_data_path' and add the results to 'self.processed_data_path'.
+        Move invalid source files out of 'self.src_data_path' to the QUARANTINE_PREFIX prefix of
+        'self.processed_data_path', and record why they are invalid in the 'quarantine' table.
+        A file that changed since it was listed is not moved, the new version is processed by the next run.
+        :param files: the invalid files of the format {file_name: reason}
+        :param files_info: the files of the run as returned by 'MyMinio.get_files_info'
+        :return: the names of the quarantined files
         """
-        csv_files, image_files = self.get_files()
+        quarantined = {}
+        for file_name, reason in sorted(files.items()):
+            etag = files_info[file_name][0]
+            if self.minioClient.move_file(self.src_data_path, file_name, self.processed_data_path,
+                                          f"{QUARANTINE_PREFIX}{file_name}", etag=etag):
+                print(f"Quarantined {file_name}: {reason}")
+                quarantined[file_name] = (etag, reason)
+                metrics.INGEST_QUARANTINED.labels('bulk' if self.is_bulk_file(file_name) else 'csv').inc()
+
+        self.pg_instance.record_quarantine('quarantine', quarantined)
+        return list(quarantined)
 
-        try:
-            test_files_validity(self.minioClient, csv_files, image_files, self.src_data_path)
-        except Exception as e:
-            print(e)
-            return
+    def add_data(self, user_data: dict):
+        """
+        Add the data of a user to 'processed_data_path' file.
 
-        for csv_file, user_id in csv_files:
+        :param user_data: a dict of the data of the user.
+        'user_data' keys are: [user_id, first_name, last_name, birthts, img_path]
+        """
+        self.merge_output([user_data], [])
 
-            contents = self.minioClient.read_csv_file_from_minio(self.src_data_path, csv_file)
+    def process_data(self, incremental: bool = INCREMENTAL_PROCESSING, progress=None, keys=None,
+                     files_info: dict = None):
+        """
+        Process the data from 'self.src_data_path' and add the results to 'self.processed_data_path'.
+        :param incremental: if True, only the users whose files are new, changed or deleted since the
+        last run are processed. Otherwise, all the users are processed again.
+        :param keys: if specified, the names of the changed files, e.g. from the bucket notifications.
+        Only the files of the users these files belong to are listed and processed.
+        :param files_info: with 'keys', the files of the users of 'keys' as returned by 'MyMinio.get_files_info',
+        e.g. from a listing of the whole bucket, instead of listing the files of each user
+        :param progress: an optional callback progress(stage, done, total) that is called when the run
+        enters a new stage. 'done' and 'total' are the number of processed and total items of the stage, if known.
+        Invalid files are moved to the quarantine, see 'quarantine_files', and the users of these files
+        are deleted, the same way as if the files had been removed.
+        :return: a summary of the run of the format
+        {users, inserted, updated, deleted, bulk_files, invalid, quarantined, thumbnails} where 'invalid' is the
+        number of invalid users: the invalid csv files of single users and the invalid rows of the bulk files
+        """
+        # record the duration of the run and of each of its stages
+        with metrics.track_run(progress) as tracker:
+            return self._process_data(incremental, tracker, keys, files_info)
+
+    def _process_data(self, incremental: bool, progress, keys, files_info):
+        # Every run writes its parquet files to a partition of its own, named after the time it started
+        batch_id = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ') \
+            if OUTPUT_FORMAT in ('parquet', 'both') else None
+
+        progress('list')
+        if keys is None:
+            files_info = self.minioClient.get_files_info(self.src_data_path)
+            manifest = self.pg_instance.get_manifest('manifest') if incremental else {}
+            all_files_info = files_info
+        else:
+            # the 'user_id' of a bulk file 'bulk/<name>.csv' is 'bulk/<name>', so its listing and manifest
+            # are restricted the same way
+            user_ids = sorted({file_to_user_id(key) for key in keys})
+            if files_info is None:
+                # one listing per user, FETCH_CONCURRENCY at a time
+                files_info = {}
+                with ThreadPoolExecutor(max_workers=max(1, min(FETCH_CONCURRENCY, len(user_ids)))) as executor:
+                    for user_files in executor.map(
+                            lambda user_id: self.minioClient.get_files_info(self.src_data_path, prefix=f"{user_id}."),
+                            user_ids):
+                        files_info.update(user_files)
+            manifest = self.pg_instance.get_manifest('manifest', user_ids) if incremental else {}
+
+            # The image of a user in a bulk file can be anywhere in the bucket, so bulk files need the full listing
+            all_files_info = self.minioClient.get_files_info(self.src_data_path) \
+                if any(self.is_bulk_file(key) for key in keys) else files_info
+
+        changed_files, removed_files = self.plan_changes(files_info, manifest)
+        csv_files, image_files = self.get_files(all_files_info)
+
+        # The bulk files are processed separately, each one on its own
+        bulk_changed = {file: info for file, info in changed_files.items() if self.is_bulk_file(file)}
+        bulk_removed = [file for file in removed_files if self.is_bulk_file(file)]
+        changed_files = {file: info for file, info in changed_files.items() if not self.is_bulk_file(file)}
+        removed_files = [file for file in removed_files if not self.is_bulk_file(file)]
+
+        # A user is deleted once the csv file of the user is removed, while a new, changed or removed
+        # image only requires to process the user again
+        deleted_ids = {file_to_user_id(file) for file in removed_files if file.endswith('.csv')}
+        changed_ids = {file_to_user_id(file) for file in list(changed_files) + removed_files}
+        changed_ids = sorted(user_id for user_id in changed_ids - deleted_ids if user_id in csv_files)
+
+        # Download each csv file once, the files that cannot be parsed are invalid
+        progress('fetch', 0, len(changed_ids))
+        invalid_files = {}
+        csv_contents = self.minioClient.read_csv_files_from_minio(
+            self.src_data_path, [csv_files[user_id] for user_id in changed_ids], FETCH_CONCURRENCY, invalid_files)
+
+        # Check and parse each file in a single pass, an invalid file does not stop the others
+        progress('validate', 0, len(csv_contents))
+        records = {}
+        for user_id in changed_ids:
+            if csv_files[user_id] not in csv_contents:
+                continue
+            record, reason = parse_user_file(csv_contents[csv_files[user_id]])
+            if reason is None:
+                records[user_id] = record
+            else:
+                invalid_files[csv_files[user_id]] = reason
+
+        quarantined = self.quarantine_files(invalid_files, all_files_info) if invalid_files else []
+        for file in invalid_files:
+            changed_files.pop(file, None)
+            if file in quarantined and (file in manifest or not incremental):
+                # the file is gone from the bucket, so its user is deleted as for a removed file
+                deleted_ids.add(file_to_user_id(file))
+                removed_files.append(file)
+        # the users of the files that changed again since the listing are processed by the next run
+        changed_ids = sorted(records)
+
+        progress('extract', 0, len(changed_ids))
+        users = []
+        for user_id in changed_ids:
+
+            record = records[user_id]
 
             user_info = {
                 'user_id': user_id,
-                'first_name': contents[3],
-                'last_name': contents[4],
-                'birthts': contents[5]
+                'first_name': record.first_name,
+                'last_name': record.last_name,
+                'birthts': record.birthts,
             }
 
-            try:
-                image_path = [image[0] for image in image_files if image[1] == user_id][0]
-                user_info['img_path'] = image_path
-            except:  # Check if the user does not have an image file
-                user_info['img_path'] = "No image found"
+            users.append(user_info)
+
+        progress('match_images', 0, len(users))
+        for user_info in users:
+            # Check if the user does not have an image file
+            user_info['img_path'] = image_files.get(user_info['user_id'], NO_IMAGE)
 
-            self.add_data(user_info)
+        progress('merge_output', 0, len(users) + len(deleted_ids))
+        if OUTPUT_FORMAT in ('csv', 'both'):
+            self.merge_output(users, list(deleted_ids))
+        if batch_id is not None:
+            self.parquet_output.write_batch(batch_id, users, sorted(deleted_ids))
 
-        contents = self.minioClient.read_csv_file_from_minio(self.processed_data_path, 'output.csv')[5:]
+        # Apply the changes of the run and record them in the manifest in a single transaction
+        progress('upsert', 0, len(users) + len(deleted_ids))
+        rows = [dict_to_db_row(user_info) for user_info in users]
+        with self.pg_instance.connection():
+            if len(deleted_ids) != 0:
+                self.pg_instance.delete_users('users', list(deleted_ids))
+            inserted, updated = self.pg_instance.insert_users('users', [item for row in rows for item in row])
 
-        self.pg_instance.insert_users('users', contents)
+            self.pg_instance.update_manifest('manifest', changed_files, removed_files)
+
+        # once the changes are committed
+        self.read_model.apply(rows, list(deleted_ids))
+
+        for file, (etag, size, last_modified) in changed_files.items():
+            kind = 'csv' if file.endswith('.csv') else 'image'
+            metrics.INGEST_OBJECTS.labels(kind).inc()
+            metrics.INGEST_BYTES.labels(kind).inc(size or 0)
+
+        summary = {'users': len(users), 'inserted': inserted, 'updated': updated, 'deleted': len(deleted_ids),
+                   'bulk_files': len(bulk_changed) + len(bulk_removed), 'invalid': len(invalid_files),
+                   'quarantined': len(quarantined), 'thumbnails': 0}
+
+        if self.image_derivatives is not None:
+            progress('derivatives', 0, None)
+            summary['thumbnails'] = self.update_derivatives(changed_files, removed_files, progress)
+
+        progress('bulk', 0, None)
+        for file in bulk_removed:
+            summary['deleted'] += self.remove_bulk_file(file, batch_id)
+            self.pg_instance.update_manifest('manifest', {}, [file])
+
+        for file in sorted(bulk_changed):
+            try:
+                bulk_summary = self.process_bulk_file(file, image_files, progress, batch_id)
+            except (InvalidFileError, UnicodeDecodeError, csv.Error) as e:
+                if not self.quarantine_files({file: str(e) or type(e).__name__}, all_files_info):
+                    continue
+                # the chunks that were processed before the error are undone with the older version of the file
+                summary['quarantined'] += 1
+                summary['deleted'] += self.remove_bulk_file(file, batch_id)
+                self.pg_instance.update_manifest('manifest', {}, [file])
+                continue
+            for key, value in bulk_summary.items():
+                summary[key] += value
+            self.pg_instance.update_manifest('manifest', {file: bulk_changed[file]}, [])
+            metrics.INGEST_OBJECTS.labels('bulk').inc()
+            metrics.INGEST_BYTES.labels('bulk').inc(bulk_changed[file][1] or 0)
+
+        for result in ('inserted', 'updated', 'deleted', 'invalid'):
+            metrics.INGEST_USERS.labels(result).inc(summary[result])
+
+        if summary['users'] != 0 or summary['deleted'] != 0 or summary['thumbnails'] != 0:
+            self.data_version += 1
+
+            if batch_id is not None:
+                progress('compact')
+                if not self.shared_locks:
+                    self.parquet_output.compact()
+                else:
+                    # a single replica compacts at a time, the others skip it
+                    with self.pg_instance.advisory_lock(f"{self.processed_data_path}/{PARQUET_PREFIX}",
+                                                        wait=False) as acquired:
+                        if acquired:
+                            self.parquet_output.compact()
+
+        print(f"Processed {summary['users']} users: {summary['inserted']} inserted, {summary['updated']} updated, "
+              f"{summary['deleted']} deleted")
+
+        return summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import functools
+import time
+import types
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+# The buckets of the durations in seconds, from the fast DB queries to the full runs over large buckets
+DURATION_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+INGEST_RUNS = Counter('ingest_runs_total', 'The runs of process_data', ['status'])
+INGEST_RUN_SECONDS = Histogram('ingest_run_duration_seconds', 'The duration of the runs of process_data',
+                               buckets=DURATION_BUCKETS)
+INGEST_STAGE_SECONDS = Histogram('ingest_stage_duration_seconds', 'The duration of each stage of process_data',
+                                 ['stage'], buckets=DURATION_BUCKETS)
+INGEST_OBJECTS = Counter('ingest_objects_total', 'The source files processed by process_data', ['kind'])
+INGEST_BYTES = Counter('ingest_bytes_total', 'The size of the source files processed by process_data', ['kind'])
+INGEST_USERS = Counter('ingest_users_total', 'The users written by process_data', ['result'])
+INGEST_QUARANTINED = Counter('ingest_quarantined_files_total', 'The invalid source files moved to the quarantine',
+                             ['kind'])
+
+MINIO_REQUEST_SECONDS = Histogram('minio_request_duration_seconds', 'The duration of the requests to minio',
+                                  ['operation'], buckets=DURATION_BUCKETS)
+MINIO_REQUEST_ERRORS = Counter('minio_request_errors_total', 'The failed requests to minio', ['operation'])
+
+POSTGRES_QUERY_SECONDS = Histogram('postgres_query_duration_seconds', 'The duration of the calls to postgres',
+                                   ['operation'], buckets=DURATION_BUCKETS)
+POSTGRES_QUERY_ERRORS = Counter('postgres_query_errors_total', 'The failed calls to postgres', ['operation'])
+
+GET_DATA_SECONDS = Histogram('get_data_request_duration_seconds', 'The duration of the GET /data requests',
+                             ['filters', 'mode'], buckets=DURATION_BUCKETS)
+
+
+def _observe(histogram: Histogram, errors: Counter, operation: str, func, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        errors.labels(operation).inc()
+        histogram.labels(operation).observe(time.perf_counter() - started)
+        raise
+
+    elapsed = time.perf_counter() - started
+    if isinstance(result, types.GeneratorType):
+        # the work of a generator happens while it is consumed, so the time spent producing its items is added
+        return _observe_generator(histogram, errors, operation, result, elapsed)
+
+    histogram.labels(operation).observe(elapsed)
+    return result
+
+
+def _observe_generator(histogram: Histogram, errors: Counter, operation: str, generator, elapsed: float):
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            except Exception:
+                errors.labels(operation).inc()
+                raise
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        generator.close()
+        histogram.labels(operation).observe(elapsed)
+
+
+def timed(histogram: Histogram, errors: Counter, operation: str = None):
+    """
+    Decorator that records the duration and the failures of each call of a function, labeled by 'operation'
+    (the name of the function by default). For the functions that return a generator, the time spent producing
+    its items is included.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _observe(histogram, errors, operation or func.__name__, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedClient:
+
+    def __init__(self, client, histogram: Histogram, errors: Counter, exclude=()):
+        """
+        Wraps a client, e.g. 'minio.Minio', to record the duration and the failures of each of its method calls,
+        labeled by the name of the method
+        :param exclude: the names of the methods that are not recorded, e.g. long-lived subscriptions
+        """
+        self._client = client
+        self._histogram = histogram
+        self._errors = errors
+        self._exclude = set(exclude)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith('_') or name in self._exclude:
+            return attribute
+
+        @functools.wraps(attribute)
+        def wrapper(*args, **kwargs):
+            return _observe(self._histogram, self._errors, name, attribute, *args, **kwargs)
+        return wrapper
+
+
+class RunTracker:
+
+    def __init__(self, progress=None):
+        """
+        Records the duration of the stages of a run of 'process_data' while forwarding them to its progress callback
+        :param progress: the progress callback of 'process_data', if any
+        """
+        self._progress = progress
+        self._stage = None
+        self._stage_started = None
+
+    def __call__(self, stage: str, done: int = None, total: int = None):
+        now = time.perf_counter()
+        if stage != self._stage:
+            self.end_stage(now)
+            self._stage, self._stage_started = stage, now
+        if self._progress is not None:
+            self._progress(stage, done, total)
+
+    def end_stage(self, now: float):
+        if self._stage is not None:
+            INGEST_STAGE_SECONDS.labels(self._stage).observe(now - self._stage_started)
+            self._stage = None
+
+
+@contextmanager
+def track_run(progress=None):
+    """
+    Records the duration and the status of a run of 'process_data' and the duration of each of its stages
+    :param progress: the progress callback of the run, if any
+    :return: the progress callback to use during the run
+    """
+    tracker = RunTracker(progress)
+    started = time.perf_counter()
+    try:
+        yield tracker
+    except Exception:
+        INGEST_RUNS.labels('failed').inc()
+        raise
+    else:
+        INGEST_RUNS.labels('succeeded').inc()
+    finally:
+        now = time.perf_counter()
+        tracker.end_stage(now)
+        INGEST_RUN_SECONDS.observe(now - started)
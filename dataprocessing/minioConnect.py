@@ -1,21 +1,35 @@
+import csv
+import hashlib
 import io
-
-from minio.select import SelectRequest, CSVInputSerialization, CSVOutputSerialization
+import math
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
 from minio import Minio
-import glob
+from minio.commonconfig import CopySource
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
 import os
 from decouple import config
 
+from dataprocessing.metrics import InstrumentedClient, MINIO_REQUEST_SECONDS, MINIO_REQUEST_ERRORS
+
 MINIO_HOST = os.getenv("MINIO_HOST", config("MINIO_HOST"))
 
+# The number of files uploaded at the same time by 'upload_local_directory_to_minio'
+UPLOAD_CONCURRENCY = config("UPLOAD_CONCURRENCY", default=8, cast=int)
+# The files larger than this number of bytes are uploaded in parts of this size (at least 5 MiB)
+MULTIPART_PART_SIZE = config("MULTIPART_PART_SIZE", default=16 * 1024 ** 2, cast=int)
+
 
 class MyMinio:
 
     def __init__(self, access, secret):
         self.access = access
         self.secret = secret
-        self.minioClient = self._getMinioClient()
+        # record the duration of the requests, except the notifications that are listened to for a long time
+        self.minioClient = InstrumentedClient(self._getMinioClient(), MINIO_REQUEST_SECONDS, MINIO_REQUEST_ERRORS,
+                                              exclude=('listen_bucket_notification',))
 
     def _getMinioClient(self):
         """
@@ -38,48 +52,192 @@ class MyMinio:
         if not self.minioClient.bucket_exists(bucket_name):
             self.minioClient.make_bucket(bucket_name)
 
-    def upload_local_directory_to_minio(self, local_path: str, bucket_name: str):
+    @staticmethod
+    def local_etag(local_file: str, part_size: int = MULTIPART_PART_SIZE):
+        """
+        Computes the ETag that minio gives to a local file uploaded with 'fput_object' and 'part_size':
+        the MD5 of the file, or for a multipart upload, the MD5 of the MD5s of its parts followed by
+        the number of parts
+        :param local_file: the path of the local file
+        :param part_size: the part size of the upload
+        :return: the ETag
+        """
+        size = os.path.getsize(local_file)
+        part_digests = []
+        with open(local_file, 'rb') as file:
+            for _ in range(max(1, math.ceil(size / part_size))):
+                md5 = hashlib.md5()
+                remaining = min(part_size, size - part_size * len(part_digests))
+                while remaining > 0:
+                    chunk = file.read(min(remaining, 1024 ** 2))
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    remaining -= len(chunk)
+                part_digests.append(md5.digest())
+
+        if len(part_digests) == 1:
+            return part_digests[0].hex()
+        return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+    def upload_local_directory_to_minio(self, local_path: str, bucket_name: str, max_workers: int = UPLOAD_CONCURRENCY,
+                                        delete_extra: bool = False, part_size: int = MULTIPART_PART_SIZE):
         """
-        Uploads local directory contents into a bucket in minio.
+        Syncs the contents of a local directory, including its subdirectories, into a bucket in minio.
+        The bucket is listed once, and the files that are already in the bucket with the same size
+        and ETag are skipped. The other files are uploaded in parallel, the large ones in parts.
         :param local_path: the path of the source local directory
         :param bucket_name: the name of the destination bucket
+        :param max_workers: the maximum number of files uploaded at the same time
+        :param delete_extra: if True, the objects of the bucket that are not in the directory are deleted
+        :param part_size: the files larger than this number of bytes are uploaded in parts of this size
+        :return: a summary of the format {uploaded, skipped, deleted}
         """
         assert os.path.isdir(local_path)
 
-        for local_file in glob.glob(local_path + '/**'):
-            local_file = local_file.replace(os.sep, "/")
-            if not os.path.isfile(local_file):
-                self.upload_local_directory_to_minio(
-                    local_file, bucket_name)
-            else:
-                remote_path = os.path.join(
-                    local_file[1 + len(local_path):])
-                remote_path = remote_path.replace(
-                    os.sep, "/")
-                self.minioClient.fput_object(bucket_name, remote_path, local_file)
-
-    def read_csv_file_from_minio(self, bucket_name: str, file_name: str):
-        """
-        Reads a csv file from minio and returns its contents
+        local_files = {}
+        for directory, _, file_names in os.walk(local_path):
+            for file_name in file_names:
+                local_file = os.path.join(directory, file_name)
+                local_files[os.path.relpath(local_file, local_path).replace(os.sep, "/")] = local_file
+
+        remote_files = self.get_files_info(bucket_name)
+
+        def sync_file(remote_path: str):
+            local_file = local_files[remote_path]
+            info = remote_files.get(remote_path)
+            # compare the sizes first, so the files are only hashed if they may be unchanged
+            if info is not None and info[1] == os.path.getsize(local_file) \
+                    and info[0].strip('"') == self.local_etag(local_file, part_size):
+                return False
+            self.minioClient.fput_object(bucket_name, remote_path, local_file, part_size=part_size)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            uploaded = sum(executor.map(sync_file, sorted(local_files)))
+
+        extra_files = [remote_path for remote_path in remote_files if remote_path not in local_files]
+        if delete_extra and extra_files:
+            self.remove_files(bucket_name, extra_files)
+
+        return {'uploaded': uploaded, 'skipped': len(local_files) - uploaded,
+                'deleted': len(extra_files) if delete_extra else 0}
+
+    def iter_csv_file_from_minio(self, bucket_name: str, file_name: str):
+        """
+        Streams a csv file from minio and parses it while it is being downloaded, so files of any size
+        are read in bounded memory
         :param bucket_name: the name of the bucket the file exists in
         :param file_name: the name of the file to read from
-        :return: the contents of the file as a list of all values alongside each other
-        """
-        with self.minioClient.select_object_content(
-                bucket_name,
-                file_name,
-                SelectRequest(
-                    "select * from S3Object",
-                    CSVInputSerialization(),
-                    CSVOutputSerialization(),
-                    request_progress=True,
-                ),
-        ) as result:
-            for data in result.stream():
-                data = data.decode().replace('\n', ',').split(',')
-                data = [item.strip('"').strip(' ') for item in data]
-                data = [item for item in data if item != '']
-                return data
+        :return: a generator of the rows of the file, each row is a list of values stripped from spaces.
+        Empty lines are skipped.
+        """
+        response = self.minioClient.get_object(bucket_name, file_name)
+
+        # keep the response open once it is exhausted, so io.TextIOWrapper can detect the end of the file
+        response.auto_close = False
+        try:
+            for row in csv.reader(io.TextIOWrapper(response, encoding='utf-8-sig', newline='')):
+                if row:
+                    yield [item.strip() for item in row]
+        finally:
+            response.close()
+            response.release_conn()
+
+    def read_csv_files_from_minio(self, bucket_name: str, file_names: list, max_workers: int, errors: dict = None):
+        """
+        Reads many csv files from minio concurrently. Each file is downloaded exactly once.
+        :param bucket_name: the name of the bucket the files exist in
+        :param file_names: the names of the files to read
+        :param max_workers: the maximum number of files that are downloaded at the same time
+        :param errors: if specified, the files that are not valid utf-8 csv files are left out of the result,
+        and the reasons why they cannot be parsed are added to 'errors' as {file_name: reason}
+        :return: a dictionary of the format {file_name: rows} where rows is the list of the rows
+        generated by 'iter_csv_file_from_minio'. The files removed since they were listed are left out.
+        """
+        if len(file_names) == 0:
+            return {}
+
+        def read(file_name: str):
+            try:
+                return list(self.iter_csv_file_from_minio(bucket_name, file_name))
+            except (UnicodeDecodeError, csv.Error) as e:
+                if errors is None:
+                    raise
+                errors[file_name] = f"cannot parse the file: {e}"
+                return None
+            except S3Error as e:
+                if e.code != 'NoSuchKey':
+                    raise
+                # removed since it was listed, the next listing does not have it anymore
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(file_names)))) as executor:
+            contents = executor.map(read, file_names)
+            return {file_name: rows for file_name, rows in zip(file_names, contents) if rows is not None}
+
+    def read_file_from_minio(self, bucket_name: str, file_name: str):
+        """
+        Reads the whole contents of a file from minio
+        :param bucket_name: the name of the bucket the file exists in
+        :param file_name: the name of the file to read from
+        :return: the contents of the file as bytes
+        """
+        response = self.minioClient.get_object(bucket_name, file_name)
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def write_file(self, bucket_name: str, file_name: str, content: bytes, content_type: str = 'text/csv'):
+        """
+        Writes 'content' into the file file_name in bucket_name. If the file already exists,
+        it is replaced at once, so readers either see the old or the new contents.
+        :param bucket_name: the name of the bucket
+        :param file_name: the name of the file to write
+        :param content: the new contents of the file
+        :param content_type: the content type of the file
+        """
+        self.minioClient.put_object(bucket_name, file_name, io.BytesIO(content), len(content),
+                                    content_type=content_type)
+
+    def move_file(self, bucket_name: str, file_name: str, dest_bucket_name: str, dest_file_name: str,
+                  etag: str = None):
+        """
+        Moves a file to another bucket or name, copying it on the server
+        :param bucket_name: the name of the bucket of the file
+        :param file_name: the name of the file
+        :param dest_bucket_name: the name of the destination bucket
+        :param dest_file_name: the new name of the file
+        :param etag: if specified, the file is only moved if its etag is still 'etag'
+        :return: True if the file was moved, False if it changed or does not exist anymore
+        """
+        try:
+            self.minioClient.copy_object(dest_bucket_name, dest_file_name,
+                                         CopySource(bucket_name, file_name, match_etag=etag))
+        except S3Error as e:
+            if e.code not in ('NoSuchKey', 'PreconditionFailed'):
+                raise
+            return False
+
+        self.minioClient.remove_object(bucket_name, file_name)
+        return True
+
+    def file_exists(self, bucket_name: str, file_name: str):
+        """
+        Checks if a file exists in a bucket
+        :param bucket_name: the name of the bucket
+        :param file_name: the name of the file
+        :return: True if the file exists, False otherwise
+        """
+        try:
+            self.minioClient.stat_object(bucket_name, file_name)
+            return True
+        except S3Error as e:
+            if e.code in ('NoSuchKey', 'NoSuchObject'):
+                return False
+            raise
 
     def add_file(self, bucket_name: str, file_name: str, content: str):
         """
@@ -101,12 +259,63 @@ class MyMinio:
 
         return [file.object_name for file in files]
 
+    def get_files_in_bucket_with_prefix(self, bucket_name: str, prefix: str):
+        """
+        Gets the names of the files inside a bucket whose names start with 'prefix', at any depth
+        :param bucket_name: the name of the bucket
+        :param prefix: the prefix of the names of the files
+        :return: a list of the names of the files
+        """
+        files = self.minioClient.list_objects(bucket_name, prefix=prefix, recursive=True)
+
+        return [file.object_name for file in files]
+
+    def get_files_info(self, bucket_name: str, prefix: str = None):
+        """
+        Gets the names of the files inside a bucket alongside the metadata that tells
+        whether a file has changed
+        :param bucket_name: the name of the bucket
+        :param prefix: if specified, only the files whose names start with 'prefix'
+        :return: a dictionary of the format {file_name: (etag, size, last_modified)}
+        """
+        files = self.minioClient.list_objects(bucket_name, prefix=prefix, recursive=True)
+
+        return {file.object_name: (file.etag, file.size, file.last_modified) for file in files}
+
+    def remove_files(self, bucket_name: str, file_names: list):
+        """
+        Removes many files from a bucket with batched delete requests
+        :param bucket_name: the name of the bucket
+        :param file_names: the names of the files to remove
+        """
+        # the deletion is lazy, the requests are sent while the errors are being iterated
+        errors = list(self.minioClient.remove_objects(
+            bucket_name, (DeleteObject(file_name) for file_name in file_names)))
+        if errors:
+            raise S3Error(errors[0].code, errors[0].message, errors[0].name, None, None, None,
+                          bucket_name=bucket_name, object_name=errors[0].name)
+
+    def listen_bucket_changes(self, bucket_name: str):
+        """
+        Listens to the notifications of the files that are created, overwritten or removed in a bucket.
+        The generator blocks until the next notification arrives, and raises if the connection fails.
+        :param bucket_name: the name of the bucket
+        :return: a generator of tuples of the format (event, file_name) where event is 'put' or 'delete'
+        """
+        with self.minioClient.listen_bucket_notification(
+                bucket_name, events=('s3:ObjectCreated:*', 's3:ObjectRemoved:*')) as events:
+            for event in events:
+                for record in event.get('Records', []):
+                    event_name = record.get('eventName', '')
+                    file_name = unquote_plus(record['s3']['object']['key'])
+                    yield ('delete' if event_name.startswith('s3:ObjectRemoved') else 'put'), file_name
+
     def clear_bucket(self, bucket_name: str):
         """
         Clears the contents of the given bucket
         :param bucket_name: the name of the bucket
         """
-        files = self.get_files_in_bucket(bucket_name)
-        for file in files:
-            self.minioClient.remove_object(bucket_name, file)
+        files = self.get_files_in_bucket_with_prefix(bucket_name, None)
+        if files:
+            self.remove_files(bucket_name, files)
 
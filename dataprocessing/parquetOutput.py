@@ -0,0 +1,115 @@
+import io
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from dataprocessing.minioConnect import MyMinio
+from dataprocessing.utils.helpers import NO_IMAGE
+
+USERS_SCHEMA = pa.schema([
+    ('user_id', pa.string()),
+    ('first_name', pa.string()),
+    ('last_name', pa.string()),
+    ('birthts', pa.int64()),
+    ('img_path', pa.string()),
+    ('has_image', pa.bool_()),
+    # True for the users that were deleted in this batch, their other columns are null
+    ('deleted', pa.bool_()),
+    ('batch_id', pa.string()),
+])
+
+
+class ParquetOutput:
+
+    def __init__(self, minioClient: MyMinio, bucket_name: str, prefix: str = 'parquet/',
+                 compression: str = 'zstd', compact_min_files: int = 10, compact_max_size: int = 64 * 1024 ** 2):
+        """
+        Writes the processed users as compressed parquet files partitioned by ingestion batch:
+        '<prefix>batch=<batch_id>/<part_name>.parquet'. Batch ids are increasing, e.g. timestamps, and every row
+        stores the id of the batch it was ingested in, so the latest record of a user is the one with
+        the greatest 'batch_id' wherever it is stored.
+        :param minioClient: the minio client
+        :param bucket_name: the name of the bucket of the parquet files
+        :param prefix: the prefix of the parquet files inside the bucket
+        :param compression: the parquet compression codec
+        :param compact_min_files: the number of small files that triggers a compaction, see 'compact'
+        :param compact_max_size: the size in bytes under which a file is considered small
+        """
+        self.minioClient = minioClient
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.compression = compression
+        self.compact_min_files = compact_min_files
+        self.compact_max_size = compact_max_size
+
+    def _write_table(self, file_name: str, table: pa.Table):
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression=self.compression)
+        self.minioClient.write_file(self.bucket_name, file_name, buffer.getvalue())
+
+    def _read_table(self, file_name: str):
+        return pq.read_table(io.BytesIO(self.minioClient.read_file_from_minio(self.bucket_name, file_name)))
+
+    def write_batch(self, batch_id: str, users: list, deleted_ids: list, part_name: str = 'part-00000'):
+        """
+        Writes the users processed in a batch as one parquet file of the partition of the batch
+        :param batch_id: the id of the batch
+        :param users: a list of dicts of the data of the users, see 'DataProcessing.merge_output'
+        :param deleted_ids: the ids of the users deleted in the batch
+        :param part_name: the name of the file inside the partition, for the batches written in many parts
+        :return: the name of the written file, or None if there was nothing to write
+        """
+        if len(users) == 0 and len(deleted_ids) == 0:
+            return None
+
+        img_paths = [user_info['img_path'] for user_info in users]
+        img_paths = [None if img_path == NO_IMAGE else img_path for img_path in img_paths]
+
+        table = pa.Table.from_pydict({
+            'user_id': [user_info['user_id'] for user_info in users] + list(deleted_ids),
+            'first_name': [user_info['first_name'] for user_info in users] + [None] * len(deleted_ids),
+            'last_name': [user_info['last_name'] for user_info in users] + [None] * len(deleted_ids),
+            'birthts': [int(user_info['birthts']) for user_info in users] + [None] * len(deleted_ids),
+            'img_path': img_paths + [None] * len(deleted_ids),
+            'has_image': [img_path is not None for img_path in img_paths] + [None] * len(deleted_ids),
+            'deleted': [False] * len(users) + [True] * len(deleted_ids),
+            'batch_id': [batch_id] * (len(users) + len(deleted_ids)),
+        }, schema=USERS_SCHEMA)
+
+        file_name = f"{self.prefix}batch={batch_id}/{part_name}.parquet"
+        self._write_table(file_name, table)
+
+        return file_name
+
+    def compact(self, force: bool = False):
+        """
+        Merges the small parquet files into one file that keeps only the latest record of each user among them.
+        The merged file is written to the partition of the most recent of the merged batches, and the small files
+        are removed afterwards. Deleted users are kept as deleted records, since older files that were not merged
+        can still contain them.
+        :param force: if True, merge the small files even if there are fewer than 'compact_min_files' of them
+        :return: the name of the merged file, or None if nothing was merged
+        """
+        files = self.minioClient.get_files_info(self.bucket_name, prefix=self.prefix)
+        small_files = sorted(file_name for file_name, (etag, size, last_modified) in files.items()
+                             if file_name.endswith('.parquet') and size < self.compact_max_size)
+
+        if len(small_files) < 2 or (len(small_files) < self.compact_min_files and not force):
+            return None
+
+        table = pa.concat_tables([self._read_table(file_name) for file_name in small_files])
+
+        # keep the row of the greatest batch_id of each user
+        table = table.sort_by([('user_id', 'ascending'), ('batch_id', 'descending')])
+        user_ids = table.column('user_id').combine_chunks()
+        is_first = pc.not_equal(user_ids.slice(1), user_ids.slice(0, len(user_ids) - 1))
+        table = table.filter(pa.concat_arrays([pa.array([True]), is_first]))
+
+        latest_batch = pc.max(table.column('batch_id')).as_py()
+        merged_file = f"{self.prefix}batch={latest_batch}/compacted-{len(small_files):05d}-{len(table)}.parquet"
+        self._write_table(merged_file, table)
+
+        self.minioClient.remove_files(self.bucket_name, [file_name for file_name in small_files
+                                                         if file_name != merged_file])
+        return merged_file
@@ -1,178 +1,868 @@
+import csv
+import io
+import json
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
+from psycopg2 import pool
+
+from dataprocessing.metrics import timed, POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS
 
 
 class MyPgConnect:
 
-    def __init__(self, dbname: str, user: str, password: str, host: str):
+    def __init__(self, dbname: str, user: str, password: str, host: str,
+                 min_connections: int = 1, max_connections: int = 10, health_check_interval: float = 30):
         """
-        Stores the connection credintials to connect to the database
+        Stores the connection credintials to connect to the database. The connections themselves are
+        opened lazily and kept in a thread-safe pool that is shared by all the users of this instance.
         :param dbname: the name of the database
         :param user: the username credential
         :param password: the password
         :param host: the host of the database
+        :param min_connections: the number of idle connections the pool keeps open
+        :param max_connections: the maximum number of connections that can be in use at the same time.
+        Callers wait for a free connection once this number is reached.
+        :param health_check_interval: connections that have been idle for more than this number of seconds
+        are checked with 'SELECT 1' before being handed out
         """
         self.dbname = dbname
         self.user = user
         self.password = password
         self.host = host
 
-    def init(self):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._last_used = {}
+        self._local = threading.local()
+
+    def _get_pool(self):
+        """
+        Creates the connection pool on first use
+        :return: the connection pool
+        """
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = pool.ThreadedConnectionPool(self.min_connections, self.max_connections,
+                                                             dbname=self.dbname, user=self.user,
+                                                             password=self.password, host=self.host)
+        return self._pool
+
+    def _is_healthy(self, conn):
+        """
+        Checks if a pooled connection can still be used
+        :param conn: the connection object
+        :return: True if the connection is usable, False otherwise
+        """
+        if conn.closed:
+            return False
+
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as crsr:
+                crsr.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        """
+        Takes a healthy connection from the pool, waiting for one if all of them are in use
+        :return: the connection object
+        """
+        self._available.acquire()
+        try:
+            while True:
+                conn = self._get_pool().getconn()
+                if self._is_healthy(conn):
+                    return conn
+                self._last_used.pop(id(conn), None)
+                self._get_pool().putconn(conn, close=True)
+        except BaseException:
+            self._available.release()
+            raise
+
+    def _checkin(self, conn, broken: bool = False):
+        """
+        Gives a connection back to the pool
+        :param conn: the connection object
+        :param broken: if True, the connection is closed instead of being reused
+        """
+        try:
+            if broken or conn.closed:
+                self._last_used.pop(id(conn), None)
+                self._get_pool().putconn(conn, close=True)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._get_pool().putconn(conn)
+        finally:
+            self._available.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of a 'with' block. All the statements executed
+        inside the block share the same connection and transaction, which is committed when the block exits
+        and rolled back if it raises. Nested calls from the same thread, including the ones made by the
+        other methods of this class, reuse the outer connection and transaction.
+
+        Example:
+            with pg_instance.connection():
+                pg_instance.delete_users('users', ids)
+                pg_instance.insert_users('users', users)
+
+        :return: the connection object
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._checkin(conn, broken)
+
+    @contextmanager
+    def cursor(self):
+        """
+        Opens a cursor on a pooled connection, see 'connection'
+        :return: the cursor to perform commands
+        """
+        with self.connection() as conn:
+            with conn.cursor() as crsr:
+                yield crsr
+
+    def close(self):
         """
-        Initiates the connection with the database 'dbname'
-        :return: (conn, crsr) -> (the connection object, the cursor to perform commands)
+        Closes all the connections of the pool
         """
-        conn = psycopg2.connect(dbname=self.dbname, user=self.user,
-                                password=self.password, host=self.host)
-        return conn, conn.cursor()
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+                self._last_used.clear()
 
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
     def delete_table(self, table_name: str):
         """
         Deletes a table from the database
         :param table_name: the table_name
         """
-        conn, crsr = self.init()
-
-        crsr.execute(f"DROP TABLE {table_name};")
-        conn.commit()
-        crsr.close()
-        conn.close()
+        with self.cursor() as crsr:
+            crsr.execute(f"DROP TABLE IF EXISTS {table_name};")
 
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
     def create_table_users(self):
         """
         Creates the table users that we will use to migrate our data from output.csv to.
+        The table created by older versions, which stored 'birthdate' as text and a missing image as
+        the text 'No image found', is migrated to the typed columns 'birthts' and a nullable 'img_path'.
+        The changes of the table are tracked for 'get_users_changes': each user records the id of the transaction
+        that last wrote it in 'change_txid', and the deleted users are kept in the table users_tombstones.
         """
-        conn, crsr = self.init()
-
-        crsr.execute("""
-            CREATE TABLE IF NOT EXISTS users(
-                id SERIAL PRIMARY KEY NOT NULL,
-                user_id varchar (50) NOT NULL,
-                first_name varchar (50) NOT NULL,
-                last_name varchar (50) NOT NULL,
-                birthdate varchar (50) NOT NULL,
-                img_path varchar (250) NOT NULL
-            );
-        """)
-
-        conn.commit()
-        crsr.close()
-        conn.close()
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS users(
+                    id SERIAL PRIMARY KEY NOT NULL,
+                    user_id varchar (50) NOT NULL,
+                    first_name varchar (50) NOT NULL,
+                    last_name varchar (50) NOT NULL,
+                    birthts bigint NOT NULL,
+                    img_path varchar (250),
+                    has_image boolean GENERATED ALWAYS AS (img_path IS NOT NULL) STORED
+                );
+            """)
+
+            crsr.execute("""
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'birthdate';
+            """)
+            if crsr.fetchone() is not None:
+                crsr.execute("""
+                    ALTER TABLE users RENAME COLUMN birthdate TO birthts;
+                    ALTER TABLE users ALTER COLUMN birthts TYPE bigint USING trim(birthts)::numeric::bigint;
+                    ALTER TABLE users ALTER COLUMN img_path DROP NOT NULL;
+                    UPDATE users SET img_path = NULL WHERE img_path = 'No image found';
+                    ALTER TABLE users ADD COLUMN has_image boolean GENERATED ALWAYS AS (img_path IS NOT NULL) STORED;
+                """)
+
+            # Older versions of the table could contain the same user more than once,
+            # keep the latest record of each user before enforcing the uniqueness of user_id
+            crsr.execute("""
+                DELETE FROM users old USING users new
+                WHERE old.user_id = new.user_id AND old.id < new.id;
+            """)
+            crsr.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_user_id_idx ON users (user_id);")
+
+            # Serve the age filters with or without the image filter
+            crsr.execute("CREATE INDEX IF NOT EXISTS users_birthts_idx ON users (birthts);")
+            crsr.execute("CREATE INDEX IF NOT EXISTS users_has_image_birthts_idx ON users (has_image, birthts);")
+
+            # The existing users of older versions of the table get the id of this transaction
+            crsr.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS "
+                         "change_txid bigint NOT NULL DEFAULT txid_current();")
+            crsr.execute("CREATE INDEX IF NOT EXISTS users_change_txid_idx ON users (change_txid);")
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS users_tombstones(
+                    user_id varchar (50) PRIMARY KEY NOT NULL,
+                    change_txid bigint NOT NULL DEFAULT txid_current()
+                );
+                CREATE INDEX IF NOT EXISTS users_tombstones_change_txid_idx ON users_tombstones (change_txid);
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def create_table_manifest(self):
+        """
+        Creates the table manifest that keeps track of the source files that have already been processed.
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS manifest(
+                    object_key varchar (1024) PRIMARY KEY NOT NULL,
+                    etag varchar (100) NOT NULL,
+                    size bigint NOT NULL,
+                    last_modified timestamptz
+                );
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_manifest(self, table_name: str, user_ids: list = None):
+        """
+        Retrieves the processed source files recorded in the 'table_name' table
+        :param table_name: the name of the manifest table
+        :param user_ids: if specified, only the files of these users, i.e. the files named '<user_id>.<extension>'
+        :return: a dictionary of the format {object_key: (etag, size, last_modified)}
+        """
+        with self.cursor() as crsr:
+            if user_ids is None:
+                crsr.execute(f"SELECT object_key, etag, size, last_modified FROM {table_name};")
+            else:
+                crsr.execute(f"SELECT object_key, etag, size, last_modified FROM {table_name} "
+                             f"WHERE split_part(object_key, '.', 1) = ANY(%s);", (list(user_ids),))
+            rows = crsr.fetchall()
+
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def update_manifest(self, table_name: str, processed: dict, removed: list):
+        """
+        Records the processed source files in the 'table_name' table and forgets the removed ones
+        :param table_name: the name of the manifest table
+        :param processed: a dictionary of the format {object_key: (etag, size, last_modified)}
+        :param removed: the keys of the source files that do not exist anymore
+        """
+        with self.cursor() as crsr:
+            if len(processed) != 0:
+                crsr.executemany(
+                    f"INSERT INTO {table_name} (object_key, etag, size, last_modified) VALUES (%s, %s, %s, %s) "
+                    f"ON CONFLICT (object_key) DO UPDATE SET etag = EXCLUDED.etag, size = EXCLUDED.size, "
+                    f"last_modified = EXCLUDED.last_modified;",
+                    [(key,) + tuple(info) for key, info in processed.items()])
+
+            if len(removed) != 0:
+                crsr.execute(f"DELETE FROM {table_name} WHERE object_key = ANY(%s);", (list(removed),))
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def create_table_image_derivatives(self):
+        """
+        Creates the table image_derivatives that keeps the metadata of the image of each user and the path
+        of its thumbnail, with the etag of the image they were generated from.
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS image_derivatives(
+                    user_id varchar (50) PRIMARY KEY NOT NULL,
+                    source_etag varchar (100) NOT NULL,
+                    width integer NOT NULL,
+                    height integer NOT NULL,
+                    bytes bigint NOT NULL,
+                    thumbnail_path varchar (250) NOT NULL
+                );
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_image_derivatives(self, table_name: str, user_ids: list):
+        """
+        Retrieves the derivatives of the images of some users from the 'table_name' table
+        :param table_name: the name of the derivatives table
+        :param user_ids: the ids of the users
+        :return: a dictionary of the format {user_id: (source_etag, width, height, bytes, thumbnail_path)}
+        """
+        if len(user_ids) == 0:
+            return {}
 
-    def clear_table(self, table_name: str):
-        conn, crsr = self.init()
-        crsr.execute(f"TRUNCATE TABLE {table_name };")
+        with self.cursor() as crsr:
+            crsr.execute(f"SELECT user_id, source_etag, width, height, bytes, thumbnail_path FROM {table_name} "
+                         f"WHERE user_id = ANY(%s);", (list(user_ids),))
+            rows = crsr.fetchall()
 
-        conn.commit()
-        crsr.close()
-        conn.close()
+        return {row[0]: tuple(row[1:]) for row in rows}
 
-    def _insert_rows(self, table_name: str, users: list):
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def update_image_derivatives(self, table_name: str, derivatives: dict):
         """
-        Uploads the given list of users into the 'users' table
-        :param users: a list of the users to be uploaded to the 'users' table
-
-        NOTE:
-        the list users should contain all the information about the users right after each other
-        without having each user in a separate list.
-        For example: users = [user_id1, first_name1, last_name1, birthdate1, img_path1, user_id2, first_name2, .....]
-
-        Required columns: (user_id, first_name, last_name, birthdate, img_path)
+        Records the derivatives of the images of some users in the 'table_name' table
+        :param table_name: the name of the derivatives table
+        :param derivatives: a dictionary of the format {user_id: (source_etag, width, height, bytes, thumbnail_path)}
         """
-        conn, crsr = self.init()
-
-        values = "(" + "%s ," * 5 + ")"
-        values = values[:-3] + values[-1] + ","
-        values = values * (len(users) // 5)
-        values = values[:-1]
-
-        crsr.execute(
-            f"INSERT INTO {table_name} (user_id, first_name, last_name, birthdate, img_path) VALUES {values}"
-            , users)
+        if len(derivatives) == 0:
+            return
+
+        with self.cursor() as crsr:
+            crsr.executemany(
+                f"INSERT INTO {table_name} (user_id, source_etag, width, height, bytes, thumbnail_path) "
+                f"VALUES (%s, %s, %s, %s, %s, %s) "
+                f"ON CONFLICT (user_id) DO UPDATE SET source_etag = EXCLUDED.source_etag, width = EXCLUDED.width, "
+                f"height = EXCLUDED.height, bytes = EXCLUDED.bytes, thumbnail_path = EXCLUDED.thumbnail_path;",
+                [(user_id,) + tuple(info) for user_id, info in derivatives.items()])
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def create_table_quarantine(self):
+        """
+        Creates the table quarantine that records the invalid source files that have been moved aside,
+        and why they are invalid.
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS quarantine(
+                    object_key varchar (1024) PRIMARY KEY NOT NULL,
+                    etag varchar (100) NOT NULL,
+                    reason text NOT NULL,
+                    quarantined_at timestamptz NOT NULL DEFAULT now()
+                );
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def record_quarantine(self, table_name: str, files: dict):
+        """
+        Records quarantined source files in the 'table_name' table. A file that is quarantined again
+        replaces its previous record.
+        :param table_name: the name of the quarantine table
+        :param files: a dictionary of the format {object_key: (etag, reason)}
+        """
+        if len(files) == 0:
+            return
+
+        with self.cursor() as crsr:
+            crsr.executemany(
+                f"INSERT INTO {table_name} (object_key, etag, reason) VALUES (%s, %s, %s) "
+                f"ON CONFLICT (object_key) DO UPDATE SET etag = EXCLUDED.etag, reason = EXCLUDED.reason, "
+                f"quarantined_at = now();",
+                [(key,) + tuple(info) for key, info in files.items()])
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def create_table_bulk_file_ids(self):
+        """
+        Creates the table bulk_file_ids, where the ids of the users of the older version of a bulk file are staged
+        while its new version is processed, to find the users that were removed from the file without holding
+        all of them in memory, see 'DataProcessing.process_bulk_file'
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS bulk_file_ids(
+                    file_name varchar (1024) NOT NULL,
+                    user_id varchar (50) NOT NULL,
+                    PRIMARY KEY (file_name, user_id)
+                );
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def stage_bulk_file_ids(self, table_name: str, file_name: str, ids: list):
+        """
+        Stages the ids of users of a bulk file in the 'table_name' table
+        :param table_name: the name of the staging table
+        :param file_name: the name of the bulk file
+        :param ids: the ids of the users
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"INSERT INTO {table_name} (file_name, user_id) SELECT %s, unnest(%s::varchar[]) "
+                         f"ON CONFLICT DO NOTHING;", (file_name, list(ids)))
 
-        conn.commit()
-        crsr.close()
-        conn.close()
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def unstage_bulk_file_ids(self, table_name: str, file_name: str, ids: list):
+        """
+        Removes staged ids of users of a bulk file from the 'table_name' table
+        :param table_name: the name of the staging table
+        :param file_name: the name of the bulk file
+        :param ids: the ids of the users
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"DELETE FROM {table_name} WHERE file_name = %s AND user_id = ANY(%s);",
+                         (file_name, list(ids)))
 
-    def _get_ids(self, table_name: str):
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def pop_bulk_file_ids(self, table_name: str, file_name: str, limit: int):
         """
-        Retrieves all the ids of the users inside the 'table_name' table
-        :param table_name: the name of the table
-        :return: a list of the ids of the users inside the table
+        Removes up to 'limit' staged ids of users of a bulk file from the 'table_name' table
+        :param table_name: the name of the staging table
+        :param file_name: the name of the bulk file
+        :param limit: the maximum number of ids
+        :return: the removed ids, an empty list once all of them are removed
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"""
+                DELETE FROM {table_name} WHERE file_name = %s AND user_id IN (
+                    SELECT user_id FROM {table_name} WHERE file_name = %s LIMIT %s
+                ) RETURNING user_id;
+            """, (file_name, file_name, limit))
+            return [row[0] for row in crsr.fetchall()]
+
+    @contextmanager
+    def advisory_lock(self, name: str, wait: bool = True):
+        """
+        Holds a postgres advisory lock for the duration of a 'with' block. The lock is shared by all the
+        processes connected to the database, e.g. several replicas of the service, and it is released by
+        postgres if the connection is lost. The lock is held on a connection of its own.
+        :param name: the name of the lock
+        :param wait: if False, do not wait for the lock if another session holds it
+        :return: True if the lock is held, False if 'wait' is False and the lock is held by another session
+        """
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor() as crsr:
+                if wait:
+                    crsr.execute("SELECT pg_advisory_lock(hashtext(%s));", (name,))
+                    acquired = True
+                else:
+                    crsr.execute("SELECT pg_try_advisory_lock(hashtext(%s));", (name,))
+                    acquired = crsr.fetchone()[0]
+            conn.commit()
+
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    try:
+                        with conn.cursor() as crsr:
+                            crsr.execute("SELECT pg_advisory_unlock(hashtext(%s));", (name,))
+                        conn.commit()
+                    except psycopg2.Error:
+                        # closing the connection releases the lock
+                        broken = True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def create_table_work_queue(self):
+        """
+        Creates the table work_queue of the source objects waiting to be processed, that the replicas
+        of the service share, see 'claim_work'
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS work_queue(
+                    work_key varchar (1024) PRIMARY KEY NOT NULL,
+                    enqueued_at timestamptz NOT NULL DEFAULT now(),
+                    leased_by varchar (100),
+                    lease_until timestamptz,
+                    attempts integer NOT NULL DEFAULT 0,
+                    last_error text
+                );
+                CREATE INDEX IF NOT EXISTS work_queue_enqueued_at_idx ON work_queue (enqueued_at);
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def enqueue_work(self, table_name: str, keys: list, max_attempts: int):
+        """
+        Adds work to the queue 'table_name'. The keys that are already queued are kept as they are,
+        except the ones that failed 'max_attempts' times, which are retried.
+        :param table_name: the name of the queue table
+        :param keys: the keys of the work
+        :param max_attempts: the number of attempts after which a key is not claimed anymore
+        """
+        if len(keys) == 0:
+            return
+
+        with self.cursor() as crsr:
+            crsr.execute(f"INSERT INTO {table_name} (work_key) SELECT unnest(%s::varchar[]) "
+                         f"ON CONFLICT (work_key) DO UPDATE SET attempts = 0, last_error = NULL "
+                         f"WHERE {table_name}.attempts >= %s "
+                         f"AND ({table_name}.lease_until IS NULL OR {table_name}.lease_until < now());",
+                         (list(keys), max_attempts))
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def claim_work(self, table_name: str, worker_id: str, limit: int, lease_seconds: float, max_attempts: int):
+        """
+        Leases the oldest work of the queue 'table_name' that is not leased by another worker.
+        The rows are locked with FOR UPDATE SKIP LOCKED, so concurrent workers claim different keys without
+        waiting for each other. A lease that is not completed or released in time expires, and the work can
+        then be claimed again, e.g. if the worker crashed.
+        :param table_name: the name of the queue table
+        :param worker_id: the id of the worker, unique among the replicas
+        :param limit: the maximum number of keys to claim
+        :param lease_seconds: the duration of the lease
+        :param max_attempts: the number of attempts after which a key is not claimed anymore
+        :return: the claimed keys
         """
-        conn, crsr = self.init()
+        with self.cursor() as crsr:
+            crsr.execute(f"""
+                WITH claimed AS (
+                    SELECT work_key FROM {table_name}
+                    WHERE (lease_until IS NULL OR lease_until < now()) AND attempts < %s
+                    ORDER BY enqueued_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE {table_name} AS queue
+                SET leased_by = %s, lease_until = now() + %s * interval '1 second', attempts = queue.attempts + 1
+                FROM claimed
+                WHERE queue.work_key = claimed.work_key
+                RETURNING queue.work_key;
+            """, (max_attempts, limit, worker_id, lease_seconds))
+            return sorted(row[0] for row in crsr.fetchall())
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def complete_work(self, table_name: str, worker_id: str, keys: list):
+        """
+        Removes the work that a worker has processed from the queue 'table_name'. The keys whose lease
+        expired and that were claimed by another worker in the meantime are kept.
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"DELETE FROM {table_name} WHERE work_key = ANY(%s) AND leased_by = %s;",
+                         (list(keys), worker_id))
 
-        crsr.execute(f"SELECT user_id FROM {table_name};")
-        ids = crsr.fetchall()
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def release_work(self, table_name: str, worker_id: str, keys: list, error: str, retry_delay: float = 0):
+        """
+        Gives back the work that a worker failed to process, so it can be claimed again
+        :param error: the reason of the failure, kept in the queue
+        :param retry_delay: the number of seconds before the work can be claimed again
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"UPDATE {table_name} SET leased_by = NULL, last_error = %s, "
+                         f"lease_until = now() + %s * interval '1 second' "
+                         f"WHERE work_key = ANY(%s) AND leased_by = %s;", (error, retry_delay, list(keys), worker_id))
 
-        conn.commit()
-        conn.close()
-        crsr.close()
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def count_work(self, table_name: str, max_attempts: int):
+        """
+        Counts the work in the queue 'table_name'
+        :return: a dictionary of the format {pending, leased, failed}
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"""
+                SELECT
+                    count(*) FILTER (WHERE attempts < %s AND (lease_until IS NULL OR lease_until < now())),
+                    count(*) FILTER (WHERE leased_by IS NOT NULL AND lease_until >= now()),
+                    count(*) FILTER (WHERE attempts >= %s AND (lease_until IS NULL OR lease_until < now()))
+                FROM {table_name};
+            """, (max_attempts, max_attempts))
+            pending, leased, failed = crsr.fetchone()
+
+        return {'pending': pending, 'leased': leased, 'failed': failed}
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def create_table_backfill_ranges(self):
+        """
+        Creates the table backfill_ranges, the checkpoints of the backfills: the ranges of work keys
+        a backfill is split into, and the ones that are completed, see 'backfill.py'
+        """
+        with self.cursor() as crsr:
+            crsr.execute("""
+                CREATE TABLE IF NOT EXISTS backfill_ranges(
+                    backfill_id varchar (100) NOT NULL,
+                    range_index integer NOT NULL,
+                    range_start varchar (1024) NOT NULL,
+                    range_end varchar (1024),
+                    completed_at timestamptz,
+                    summary jsonb,
+                    last_error text,
+                    PRIMARY KEY (backfill_id, range_index)
+                );
+            """)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_backfill_ranges(self, table_name: str, backfill_id: str):
+        """
+        Retrieves the ranges of a backfill
+        :param table_name: the name of the checkpoints table
+        :param backfill_id: the id of the backfill
+        :return: the ranges ordered by index, of the format [(range_start, range_end, summary)] where 'range_end'
+        is None for the last range and 'summary' is None for the ranges that are not completed
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"SELECT range_start, range_end, CASE WHEN completed_at IS NOT NULL THEN summary END "
+                         f"FROM {table_name} WHERE backfill_id = %s ORDER BY range_index;", (backfill_id,))
+            return [tuple(row) for row in crsr.fetchall()]
 
-        return [id[0] for id in ids]
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def plan_backfill_ranges(self, table_name: str, backfill_id: str, starts: list):
+        """
+        Records the ranges of a new backfill, replacing the ones of a previous backfill with the same id
+        :param table_name: the name of the checkpoints table
+        :param backfill_id: the id of the backfill
+        :param starts: the sorted first keys of the ranges, each range ends where the next one starts
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"DELETE FROM {table_name} WHERE backfill_id = %s;", (backfill_id,))
+            crsr.executemany(
+                f"INSERT INTO {table_name} (backfill_id, range_index, range_start, range_end) VALUES (%s, %s, %s, %s);",
+                [(backfill_id, index, start, starts[index + 1] if index + 1 < len(starts) else None)
+                 for index, start in enumerate(starts)])
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def checkpoint_backfill_range(self, table_name: str, backfill_id: str, range_index: int,
+                                  summary: dict = None, error: str = None):
+        """
+        Records that a range of a backfill is completed, or why it failed
+        :param summary: the summary of the processing of the range, if it is completed
+        :param error: the reason of the failure, if it failed
+        """
+        with self.cursor() as crsr:
+            if error is None:
+                crsr.execute(f"UPDATE {table_name} SET completed_at = now(), summary = %s, last_error = NULL "
+                             f"WHERE backfill_id = %s AND range_index = %s;",
+                             (json.dumps(summary), backfill_id, range_index))
+            else:
+                crsr.execute(f"UPDATE {table_name} SET last_error = %s WHERE backfill_id = %s AND range_index = %s;",
+                             (error, backfill_id, range_index))
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def clear_table(self, table_name: str):
+        with self.cursor() as crsr:
+            crsr.execute(f"TRUNCATE TABLE {table_name };")
 
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
     def delete_rows_by_ids(self, table_name: str, ids: list):
         """
         Deletes rows from the table table_name that has an id in 'ids'
         :param table_name: the name of the table
         :param ids: the ids of the rows we want to delete from the table
         """
-        condition = f" user_id = %s OR" * len(ids)
-        condition = condition[:-3]
-
-        conn, crsr = self.init()
-
-        crsr.execute(f"DELETE FROM {table_name} WHERE {condition}", ids)
-
-        conn.commit()
-        conn.close()
-        crsr.close()
+        with self.cursor() as crsr:
+            crsr.execute(f"DELETE FROM {table_name} WHERE user_id = ANY(%s);", (list(ids),))
 
-    def get_users_data(self, table_name: str):
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def delete_users(self, table_name: str, ids: list):
         """
-        Retrieves all the data in the table table_name
-        :param table_name: the name of the table
-        :return: a list that contains all the data in the table
+        Deletes users from the table table_name, and records their deletion in the table '<table_name>_tombstones'
+        so the deletions are returned by 'get_users_changes'
+        :param table_name: the name of the users table
+        :param ids: the ids of the users to delete
+        """
+        with self.cursor() as crsr:
+            crsr.execute(f"""
+                WITH deleted AS (
+                    DELETE FROM {table_name} WHERE user_id = ANY(%s) RETURNING user_id
+                )
+                INSERT INTO {table_name}_tombstones (user_id) SELECT user_id FROM deleted
+                ON CONFLICT (user_id) DO UPDATE SET change_txid = EXCLUDED.change_txid;
+            """, (list(ids),))
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_changes_watermark(self):
+        """
+        :return: the current watermark of 'get_users_changes', to only read the changes made from now on
+        """
+        with self.cursor() as crsr:
+            crsr.execute("SELECT txid_snapshot_xmin(txid_current_snapshot());")
+            return crsr.fetchone()[0]
 
-        NOTE:
-        the returned list will contain all the information about the users right after each other
-        without having each user in a separate list.
-        For example: returned_list = [user_id1, first_name1, last_name1, birthdate1, img_path1, user_id2, first_name2, .....]
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_users_changes(self, table_name: str, since: int):
         """
-        conn, crsr = self.init()
+        Retrieves the users of the table table_name that were written or deleted since a watermark.
+        The watermark is the oldest transaction that was still running when the changes were read: all the
+        transactions before it are over, so the changes of the transactions that commit later are never
+        before the watermark, and reading from the returned watermark never misses a change.
+        :param table_name: the name of the users table
+        :param since: the watermark returned by the previous call, 0 to read all the users
+        :return: (rows, deleted_ids, watermark) -> the written users as rows of the format
+        (user_id, first_name, last_name, birthts, img_path), the ids of the deleted users,
+        and the watermark of the next call
+        """
+        with self.cursor() as crsr:
+            watermark = self.get_changes_watermark()
 
-        crsr.execute(f"SELECT user_id, first_name, last_name, birthdate, img_path FROM {table_name};")
-        data = crsr.fetchall()
+            crsr.execute(f"SELECT user_id, first_name, last_name, birthts, img_path FROM {table_name} "
+                         f"WHERE change_txid >= %s AND change_txid < %s;", (since, watermark))
+            rows = crsr.fetchall()
 
-        conn.commit()
-        crsr.close()
-        conn.close()
+            crsr.execute(f"SELECT user_id FROM {table_name}_tombstones "
+                         f"WHERE change_txid >= %s AND change_txid < %s;", (since, watermark))
+            deleted_ids = [row[0] for row in crsr.fetchall()]
 
-        returned_list = []
-        for row in data:
-            returned_list.extend(row)
-        return returned_list
+        return rows, deleted_ids, watermark
 
-    def insert_users(self, table_name: str, users: list):
+    @staticmethod
+    def _users_conditions(has_image: bool = None, min_birthts: int = None, max_birthts: int = None,
+                          after: str = None):
+        """
+        Builds the parameterized WHERE clause of the filters of 'get_users_data'
+        :return: (where, params) -> the WHERE clause (empty if there are no filters) and its parameters
+        """
+        conditions, params = [], []
+
+        if has_image is not None:
+            conditions.append("has_image = %s")
+            params.append(has_image)
+        if min_birthts is not None:
+            conditions.append("birthts >= %s")
+            params.append(min_birthts)
+        if max_birthts is not None:
+            conditions.append("birthts <= %s")
+            params.append(max_birthts)
+        if after is not None:
+            conditions.append("user_id > %s")
+            params.append(after)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, params
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def get_users_data(self, table_name: str, has_image: bool = None,
+                       min_birthts: int = None, max_birthts: int = None, after: str = None, limit: int = None):
+        """
+        Retrieves the data of the users in the table table_name that match the given filters.
+        The filters are applied by the DB, so only the matching rows are read.
+        :param table_name: the name of the table
+        :param has_image: if specified, only the users that have (True) or do not have (False) an image
+        :param min_birthts: if specified, only the users born at or after this timestamp ms
+        :param max_birthts: if specified, only the users born at or before this timestamp ms
+        :param after: if specified, only the users whose user_id comes after this one. Used to read
+        the table page by page, ordered by user_id
+        :param limit: if specified, the maximum number of users to read, ordered by user_id
+        :return: a list of the rows of the format (user_id, first_name, last_name, birthts, img_path)
+        where img_path is None for the users that do not have an image
+        """
+        where, params = self._users_conditions(has_image, min_birthts, max_birthts, after)
+
+        query = f"SELECT user_id, first_name, last_name, birthts, img_path FROM {table_name} {where}"
+        if after is not None or limit is not None:
+            query += " ORDER BY user_id"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit)
+
+        with self.cursor() as crsr:
+            crsr.execute(query + ";", params)
+            return crsr.fetchall()
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def iter_users_data(self, table_name: str, has_image: bool = None,
+                        min_birthts: int = None, max_birthts: int = None, batch_size: int = 1000):
         """
-        Process users data before inserting them into the DB. Checks for already existing
-        users and delete their old records. Then insert all rows as a batch into the DB.
+        Same as 'get_users_data', but reads the rows lazily through a server-side cursor, 'batch_size'
+        rows at a time, so the whole table can be read in constant memory.
+        A connection of the pool is kept busy until the generator is exhausted or closed.
+        :return: a generator of the rows of the format (user_id, first_name, last_name, birthts, img_path)
+        """
+        where, params = self._users_conditions(has_image, min_birthts, max_birthts)
+
+        # The generator can be resumed or closed from any thread, so the connection is not
+        # bound to the thread like the ones of 'connection'
+        conn = self._checkout()
+        broken = False
+        try:
+            with conn.cursor(name=f"{table_name}_stream") as crsr:
+                crsr.itersize = batch_size
+                crsr.execute(f"SELECT user_id, first_name, last_name, birthts, img_path FROM {table_name} {where};",
+                             params)
+                for row in crsr:
+                    yield row
+            conn.commit()
+        except BaseException as e:
+            broken = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    @timed(POSTGRES_QUERY_SECONDS, POSTGRES_QUERY_ERRORS)
+    def insert_users(self, table_name: str, users: list, chunk_size: int = 50000):
+        """
+        Upserts users data into the DB. The users are streamed with 'COPY' into a temporary staging table
+        and then merged into 'table_name' with 'INSERT ... ON CONFLICT (user_id) DO UPDATE', 'chunk_size'
+        users at a time. Rows whose data did not change are left untouched, and the new or changed rows record
+        the id of the transaction in 'change_txid', see 'get_users_changes'.
         :param table_name: the name of the table to insert the data in
         :param users: a list of the users to be uploaded to the 'users' table
+        :param chunk_size: the maximum number of users that are sent to the DB in one 'COPY'
+        :return: (inserted, updated) -> the number of new users and the number of existing users that changed
 
         NOTE:
         the list users should contain all the information about the users right after each other
         without having each user in a separate list.
-        For example: users = [user_id1, first_name1, last_name1, birthdate1, img_path1, user_id2, first_name2, .....]
+        For example: users = [user_id1, first_name1, last_name1, birthts1, img_path1, user_id2, first_name2, .....]
+        where birthts is a timestamp ms and img_path is None for the users that do not have an image.
+        If a user appears more than once, the last occurrence wins.
         """
-        db_users_ids = self._get_ids(table_name)
-
-        existing_users_ids = []
-        for i in range(0, len(users), 5):
-            if users[i] in db_users_ids:
-                existing_users_ids.append(users[i])
-
-        if len(existing_users_ids) != 0:
-            self.delete_rows_by_ids(table_name, existing_users_ids)
-        if len(users) != 0:
-            self._insert_rows('users', users)
-
+        rows = {users[i]: users[i: i + 5] for i in range(0, len(users), 5)}
+        rows = list(rows.values())
+
+        inserted, updated = 0, 0
+        if len(rows) == 0:
+            return inserted, updated
+
+        columns = "user_id, first_name, last_name, birthts, img_path"
+        staging_table = f"{table_name}_staging"
+
+        with self.cursor() as crsr:
+            crsr.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {staging_table} ON COMMIT DROP AS
+                SELECT {columns} FROM {table_name} WITH NO DATA;
+            """)
+
+            for i in range(0, len(rows), chunk_size):
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows[i: i + chunk_size])
+                buffer.seek(0)
+
+                crsr.execute(f"TRUNCATE TABLE {staging_table};")
+                crsr.copy_expert(f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv);", buffer)
+
+                crsr.execute(f"""
+                    WITH upserted AS (
+                        INSERT INTO {table_name} ({columns})
+                        SELECT {columns} FROM {staging_table}
+                        ON CONFLICT (user_id) DO UPDATE SET
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name,
+                            birthts = EXCLUDED.birthts,
+                            img_path = EXCLUDED.img_path,
+                            change_txid = txid_current()
+                        WHERE ({table_name}.first_name, {table_name}.last_name,
+                               {table_name}.birthts, {table_name}.img_path)
+                            IS DISTINCT FROM (EXCLUDED.first_name, EXCLUDED.last_name,
+                                              EXCLUDED.birthts, EXCLUDED.img_path)
+                        RETURNING (xmax = 0) AS is_new
+                    )
+                    SELECT count(*) FILTER (WHERE is_new), count(*) FILTER (WHERE NOT is_new) FROM upserted;
+                """)
+                chunk_inserted, chunk_updated = crsr.fetchone()
+
+                # the users that come back are not deleted anymore
+                if chunk_inserted:
+                    crsr.execute(f"DELETE FROM {table_name}_tombstones tombstones USING {staging_table} staging "
+                                 f"WHERE tombstones.user_id = staging.user_id;")
+                inserted += chunk_inserted
+                updated += chunk_updated
+
+        return inserted, updated
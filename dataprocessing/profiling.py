@@ -0,0 +1,123 @@
+import cProfile
+import datetime
+import functools
+import io
+import marshal
+import pstats
+import random
+import threading
+from contextlib import contextmanager
+
+from decouple import config
+
+from dataprocessing.minioConnect import MyMinio
+
+# The fraction of the data processing runs and of the GET /data requests that are profiled, between 0 and 1
+PROFILE_INGEST_RATE = config("PROFILE_INGEST_RATE", default=0.0, cast=float)
+PROFILE_REQUEST_RATE = config("PROFILE_REQUEST_RATE", default=0.0, cast=float)
+# A request is also profiled if its 'X-Profile' header holds this token. Empty to ignore the header.
+PROFILE_TOKEN = config("PROFILE_TOKEN", default='')
+PROFILE_BUCKET = config("PROFILE_BUCKET", default='profiles')
+
+# The call sites listed in the summary of a profile: the calls to minio, postgres and the helpers
+SUMMARY_FILTER = r'minioConnect|postgresConnect|helpers'
+SUMMARY_SIZE = 30
+
+
+class Profiler:
+
+    def __init__(self, minioClient: MyMinio, bucket_name: str = PROFILE_BUCKET,
+                 ingest_rate: float = PROFILE_INGEST_RATE, request_rate: float = PROFILE_REQUEST_RATE,
+                 token: str = PROFILE_TOKEN):
+        """
+        Profiles a sample of the data processing runs and of the requests with cProfile, and saves each profile
+        to 'bucket_name' for offline analysis: '<kind>/<time>-<name>.prof', which can be loaded with
+        'pstats.Stats' or snakeviz, and '<kind>/<time>-<name>.txt', a summary of the slowest call sites in
+        'MyMinio', 'MyPgConnect' and 'helpers'. A single call is profiled at a time, the calls that start while
+        another one is profiled are not. cProfile follows the thread of the call, so the work done in thread
+        pools mostly shows up as the time the call waits for them.
+        :param minioClient: the minio client
+        :param bucket_name: the bucket of the profiles, created if needed
+        :param ingest_rate: the fraction of the data processing runs that are profiled
+        :param request_rate: the fraction of the requests that are profiled
+        :param token: the token that requests can send to be profiled, empty to only sample the requests
+        """
+        self.minioClient = minioClient
+        self.bucket_name = bucket_name
+        self.rates = {'ingest': ingest_rate, 'request': request_rate}
+        self.token = token
+
+        self._lock = threading.Lock()
+
+    def should_profile(self, kind: str, token: str = None):
+        """
+        Decides whether a call is profiled
+        :param kind: 'ingest' or 'request'
+        :param token: the token sent with a request, if any
+        """
+        if self.token and token == self.token:
+            return True
+        rate = self.rates.get(kind, 0)
+        return rate > 0 and random.random() < rate
+
+    @contextmanager
+    def profile(self, kind: str, name: str, enabled: bool = True):
+        """
+        Profiles the 'with' block, and saves the profile once the block exits, even if it raises
+        :param kind: the kind of the profiled call, the prefix of the profile in the bucket
+        :param name: the name of the profiled call, e.g. the route of the request
+        :param enabled: if False, nothing is profiled
+        :return: the name of the profile in the bucket, or None if the block is not profiled
+        """
+        if not enabled or not self._lock.acquire(blocking=False):
+            yield None
+            return
+
+        try:
+            file_name = f"{kind}/{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}-{name}"
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # another profiler is already active, e.g. a debugger
+                print(f"Failed to profile {file_name}: {e}")
+                yield None
+                return
+
+            try:
+                yield file_name
+            finally:
+                profile.disable()
+                self.save(file_name, profile)
+        finally:
+            self._lock.release()
+
+    def wrap(self, kind: str, func):
+        """
+        Wraps a function to profile a sample of its calls, e.g. the run function of 'IngestJobs'
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.profile(kind, func.__name__, self.should_profile(kind)):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def save(self, file_name: str, profile: cProfile.Profile):
+        """
+        Saves a profile and the summary of its slowest call sites to the bucket. The failures are printed,
+        so they do not fail the profiled call.
+        """
+        try:
+            summary = io.StringIO()
+            stats = pstats.Stats(profile, stream=summary)
+            stats.sort_stats('cumulative').print_stats(SUMMARY_FILTER, SUMMARY_SIZE)
+
+            self.minioClient.create_bucket(self.bucket_name)
+            # the format of 'pstats.Stats.dump_stats'
+            self.minioClient.write_file(self.bucket_name, f"{file_name}.prof", marshal.dumps(stats.stats),
+                                        content_type='application/octet-stream')
+            self.minioClient.write_file(self.bucket_name, f"{file_name}.txt", summary.getvalue().encode(),
+                                        content_type='text/plain')
+            print(f"Saved the profile {self.bucket_name}/{file_name}.prof")
+        except Exception as e:
+            print(f"Failed to save the profile {file_name}: {e}")
@@ -0,0 +1,232 @@
+import threading
+import time
+
+import numpy as np
+
+from dataprocessing.utils.helpers import YEAR_MILLIS
+
+
+class _Columns:
+    """
+    A snapshot of the users, one numpy array per column, all in the same order. The snapshots share the buffers
+    of the columns: a newer snapshot only appends rows after the rows of the older ones, and masks the older rows
+    of the users it changes or deletes in 'live', so the older snapshots stay valid while they are read.
+    """
+
+    NAMES = ('user_ids', 'first_names', 'last_names', 'birthts', 'img_paths', 'has_image')
+
+    def __init__(self, buffers: dict, size: int, live, positions: dict):
+        """
+        :param buffers: the columns by name, with room for more rows after the first 'size' rows
+        :param size: the number of rows of the snapshot
+        :param live: the rows of the snapshot that are current, as a boolean array of 'size' items
+        :param positions: the position of the current row of each user, shared with the newer snapshots
+        and only used under the lock of 'UsersReadModel'
+        """
+        self.buffers = buffers
+        self.size = size
+        self.live = live
+        self.positions = positions
+
+        # views of the first 'size' rows, without copies
+        self.user_ids, self.first_names, self.last_names, self.birthts, self.img_paths, self.has_image = \
+            (buffers[name][:size] for name in self.NAMES)
+
+    @staticmethod
+    def _arrays(rows: list):
+        columns = list(zip(*rows)) if rows else [(), (), (), (), ()]
+        arrays = [np.array(column, dtype=np.int64 if i == 3 else object) for i, column in enumerate(columns)]
+        arrays.append(np.array([img_path is not None for img_path in columns[4]], dtype=bool))
+        return dict(zip(_Columns.NAMES, arrays))
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """
+        :param rows: the rows of the format (user_id, first_name, last_name, birthts, img_path)
+        where img_path is None for the users that do not have an image
+        """
+        buffers = cls._arrays(rows)
+        size = len(buffers['user_ids'])
+        positions = {user_id: i for i, user_id in enumerate(buffers['user_ids'].tolist())}
+        return cls(buffers, size, np.ones(size, dtype=bool), positions)
+
+    def compacted(self):
+        """
+        :return: a snapshot of the current rows only, with buffers of its own
+        """
+        kept = np.flatnonzero(self.live)
+        buffers = {name: self.buffers[name][kept] for name in self.NAMES}
+        positions = {user_id: i for i, user_id in enumerate(buffers['user_ids'].tolist())}
+        return _Columns(buffers, len(kept), np.ones(len(kept), dtype=bool), positions)
+
+    def updated(self, rows: list, deleted_ids: list):
+        """
+        Builds the next snapshot: the rows of the deleted and changed users are masked, and the new rows are
+        appended. Only the appended rows and the 'live' mask are written, the other rows are shared.
+        :param rows: the added or changed users, one row per user
+        :param deleted_ids: the ids of the deleted users
+        :return: the new snapshot
+        """
+        size = self.size + len(rows)
+        live = np.zeros(size, dtype=bool)
+        live[:self.size] = self.live
+        live[self.size:] = True
+        for user_id in list(deleted_ids) + [row[0] for row in rows]:
+            position = self.positions.pop(user_id, None)
+            if position is not None:
+                live[position] = False
+
+        buffers = self.buffers
+        if size > len(buffers['user_ids']):
+            # grow the buffers geometrically, so the rows are copied O(1) times on average
+            capacity = max(size, 2 * len(buffers['user_ids']))
+            grown = {}
+            for name in self.NAMES:
+                grown[name] = np.empty(capacity, dtype=buffers[name].dtype)
+                grown[name][:self.size] = buffers[name][:self.size]
+            buffers = grown
+
+        for name, values in self._arrays(rows).items():
+            buffers[name][self.size:size] = values
+        for i, row in enumerate(rows):
+            self.positions[row[0]] = self.size + i
+
+        return _Columns(buffers, size, live, self.positions)
+
+
+class UsersReadModel:
+
+    def __init__(self, load_rows):
+        """
+        An in-memory columnar copy of the 'users' table that answers the filters and the aggregates of the users
+        without querying postgres. The filters are evaluated as vectorized masks over the columns.
+        The copy is loaded on first use and is then kept up to date by 'apply', with the changes of each ingest.
+        Each update builds a new snapshot that shares the unchanged rows of the previous one, so the readers never
+        wait for the writers, and an update only goes through the changed users in python.
+        :param load_rows: a function that returns the rows of all the users, of the format
+        (user_id, first_name, last_name, birthts, img_path), e.g. 'MyPgConnect.iter_users_data'
+        """
+        self.load_rows = load_rows
+
+        self._columns = None
+        self._lock = threading.Lock()
+
+    def _get_columns(self):
+        columns = self._columns
+        if columns is None:
+            with self._lock:
+                if self._columns is None:
+                    self._columns = _Columns.from_rows(list(self.load_rows()))
+                columns = self._columns
+        return columns
+
+    def reload(self):
+        """
+        Reloads all the users, e.g. to see the changes made by other replicas of the service
+        """
+        with self._lock:
+            self._columns = _Columns.from_rows(list(self.load_rows()))
+
+    def apply(self, users: list, deleted_ids: list):
+        """
+        Applies the changes of an ingest, after they have been written to postgres. Nothing is done if the
+        model is not loaded yet, since the next load reads the changes from postgres.
+        :param users: the added or changed users, as rows of the 'users' table, see 'dict_to_db_row'
+        :param deleted_ids: the ids of the deleted users
+        """
+        if len(users) == 0 and len(deleted_ids) == 0:
+            return
+
+        with self._lock:
+            columns = self._columns
+            if columns is None:
+                return
+
+            # one row per user, the last one wins
+            rows = list({row[0]: row for row in users}.values())
+            columns = columns.updated(rows, deleted_ids)
+            # drop the masked rows once they are the majority
+            if 2 * len(columns.positions) < columns.size:
+                columns = columns.compacted()
+            self._columns = columns
+
+    @staticmethod
+    def _mask(columns: _Columns, has_image: bool = None, min_birthts: int = None, max_birthts: int = None):
+        mask = columns.live.copy()
+        if has_image is not None:
+            mask &= columns.has_image if has_image else ~columns.has_image
+        if min_birthts is not None:
+            mask &= columns.birthts >= min_birthts
+        if max_birthts is not None:
+            mask &= columns.birthts <= max_birthts
+        return mask
+
+    def get_users_data(self, has_image: bool = None, min_birthts: int = None, max_birthts: int = None):
+        """
+        Same as 'MyPgConnect.get_users_data' without paging
+        :return: a list of the rows of the format (user_id, first_name, last_name, birthts, img_path)
+        """
+        columns = self._get_columns()
+        selected = np.flatnonzero(self._mask(columns, has_image, min_birthts, max_birthts))
+
+        return list(zip(columns.user_ids[selected].tolist(), columns.first_names[selected].tolist(),
+                        columns.last_names[selected].tolist(), columns.birthts[selected].tolist(),
+                        columns.img_paths[selected].tolist()))
+
+    def get_users_columns(self, has_image: bool = None, min_birthts: int = None, max_birthts: int = None):
+        """
+        Same as 'get_users_data', but the users are returned as columns, without a tuple per user
+        :return: a dictionary of the format {user_id: [...], first_name: [...], last_name: [...], birthts: [...],
+        img_path: [...]}
+        """
+        columns = self._get_columns()
+        selected = np.flatnonzero(self._mask(columns, has_image, min_birthts, max_birthts))
+
+        return {
+            'user_id': columns.user_ids[selected].tolist(),
+            'first_name': columns.first_names[selected].tolist(),
+            'last_name': columns.last_names[selected].tolist(),
+            'birthts': columns.birthts[selected].tolist(),
+            'img_path': columns.img_paths[selected].tolist(),
+        }
+
+    def get_stats(self, has_image: bool = None, min_birthts: int = None, max_birthts: int = None,
+                  age_bin: float = 10):
+        """
+        Computes the aggregates of the users that match the filters of 'get_users_data'
+        :param age_bin: the width in years of the bins of the age histogram
+        :return: a dictionary of the format
+        {
+            users: the number of users,
+            with_image: the number of users that have an image,
+            image_coverage: the fraction of the users that have an image (None if there are no users),
+            age: {min, max, mean} in years (None if there are no users),
+            age_histogram: [{from, to, users}, ...] the number of users by bins of 'age_bin' years,
+            without the empty bins at both ends
+        }
+        """
+        columns = self._get_columns()
+        mask = self._mask(columns, has_image, min_birthts, max_birthts)
+
+        users = int(np.count_nonzero(mask))
+        with_image = int(np.count_nonzero(columns.has_image & mask))
+        stats = {
+            'users': users,
+            'with_image': with_image,
+            'image_coverage': with_image / users if users else None,
+            'age': None,
+            'age_histogram': [],
+        }
+        if users == 0:
+            return stats
+
+        ages = (time.time() * 1000 - columns.birthts[mask]) / YEAR_MILLIS
+        stats['age'] = {'min': float(ages.min()), 'max': float(ages.max()), 'mean': float(ages.mean())}
+
+        bins = np.floor(ages / age_bin).astype(np.int64)
+        first_bin = int(bins.min())
+        counts = np.bincount(bins - first_bin)
+        stats['age_histogram'] = [{'from': (first_bin + i) * age_bin, 'to': (first_bin + i + 1) * age_bin,
+                                   'users': int(count)} for i, count in enumerate(counts)]
+        return stats
+
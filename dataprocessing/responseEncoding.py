@@ -0,0 +1,123 @@
+import gzip
+import json
+from json.encoder import encode_basestring_ascii
+
+import pyarrow as pa
+
+from dataprocessing.utils.helpers import NO_IMAGE
+
+# The representations of the users returned by GET /data, negotiated with the 'Accept' header
+JSON = 'application/json'
+# {"data": {"user_id": [...], "first_name": [...], ...}} one array per column
+COLUMNAR_JSON = 'application/vnd.columnar+json'
+# an Arrow IPC stream of a single table, see 'USERS_COLUMNS'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+MEDIA_TYPES = [JSON, COLUMNAR_JSON, ARROW_STREAM]
+
+# The compressions of the responses, negotiated with the 'Accept-Encoding' header, in order of preference
+CONTENT_ENCODINGS = ['zstd', 'gzip']
+
+USERS_COLUMNS = pa.schema([
+    ('user_id', pa.string()),
+    ('first_name', pa.string()),
+    ('last_name', pa.string()),
+    ('birthts', pa.int64()),
+    # null for the users that do not have an image
+    ('img_path', pa.string()),
+])
+
+
+def rows_to_columns(rows: list):
+    """
+    Transposes rows of the 'users' table to columns
+    :param rows: the rows of the format (user_id, first_name, last_name, birthts, img_path)
+    :return: a dictionary of the format {column: values}
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(USERS_COLUMNS)
+    return {name: list(values) for name, values in zip(USERS_COLUMNS.names, columns)}
+
+
+def encode_columnar_json(columns: dict, next_cursor: str = None, paged: bool = False):
+    """
+    Encodes the columns of the users as a single JSON object, without a JSON object per user
+    :param columns: the columns of the format {column: values}
+    :param next_cursor: the cursor of the next page, see 'DataProcessing.get_data_page'
+    :param paged: if True, the 'next_cursor' is added to the object
+    :return: the encoded object as bytes
+    """
+    content = {'data': columns}
+    if paged:
+        content['next_cursor'] = next_cursor
+    return json.dumps(content, separators=(',', ':')).encode()
+
+
+def encode_keyed_json(columns: dict, next_cursor: str = None, paged: bool = False):
+    """
+    Encodes the columns of the users as the JSON object of 'DataProcessing.get_data', keyed by user_id, or of
+    'DataProcessing.get_data_page' if 'paged'. The object is written straight from the columns, without a dict
+    per user, with the same bytes as 'jsonify' (sorted keys, ASCII only), so the ETags do not change.
+    :param columns: the columns of the format {column: values}, see 'encode_arrow_stream'
+    :return: the encoded object as bytes
+    """
+    def encode(value):
+        return 'null' if value is None else encode_basestring_ascii(value)
+
+    extra = sorted(name for name in columns if name not in USERS_COLUMNS.names)
+    values = [columns['user_id'], columns['birthts'], columns['first_name'], columns['img_path'],
+              columns['last_name']] + [columns[name] for name in extra]
+    extra_keys = [f',{encode(name)}:' for name in extra]
+
+    users = []
+    for user_id, birthts, first_name, img_path, last_name, *others in sorted(zip(*values), key=lambda row: row[0]):
+        users.append(f'{encode(user_id)}:{{"birthts":"{birthts}","first_name":{encode(first_name)},'
+                     f'"img_path":{encode(img_path if img_path is not None else NO_IMAGE)},'
+                     f'"last_name":{encode(last_name)}'
+                     + ''.join(key + encode(value) for key, value in zip(extra_keys, others)) + '}')
+    body = '{' + ','.join(users) + '}'
+
+    if paged:
+        body = f'{{"data":{body},"next_cursor":{encode(next_cursor)}}}'
+    return (body + '\n').encode()
+
+
+def encode_arrow_stream(columns: dict, next_cursor: str = None, paged: bool = False):
+    """
+    Encodes the columns of the users as an Arrow IPC stream. The cursor of the next page, if any,
+    is stored in the metadata of the schema as 'next_cursor'.
+    :param columns: the columns of the format {column: values}, with the columns of 'USERS_COLUMNS'
+    and optionally other string columns, e.g. 'thumbnail_path'
+    :return: the stream as bytes
+    """
+    schema = pa.schema([USERS_COLUMNS.field(name) if name in USERS_COLUMNS.names else pa.field(name, pa.string())
+                        for name in columns])
+    if paged and next_cursor is not None:
+        schema = schema.with_metadata({'next_cursor': next_cursor})
+    table = pa.table([pa.array(values, type=field.type) for values, field in zip(columns.values(), schema)],
+                     schema=schema)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode_columns(media_type: str, columns: dict, next_cursor: str = None, paged: bool = False):
+    """
+    Encodes the columns of the users in one of the columnar representations of 'MEDIA_TYPES'
+    """
+    if media_type == ARROW_STREAM:
+        return encode_arrow_stream(columns, next_cursor, paged)
+    return encode_columnar_json(columns, next_cursor, paged)
+
+
+def compress(body: bytes, content_encoding: str = None):
+    """
+    Compresses the body of a response
+    :param content_encoding: one of 'CONTENT_ENCODINGS', or None to keep the body as it is
+    :return: the compressed body
+    """
+    if content_encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if content_encoding == 'zstd':
+        return pa.compress(body, codec='zstd', asbytes=True)
+    return body
@@ -1,10 +1,29 @@
 import _io
 import csv
 import datetime
-from dataprocessing.minioConnect import MyMinio
 import time
+import zlib
+from collections import namedtuple
 epoch = datetime.datetime.utcfromtimestamp(0)
 
+# The value of 'img_path' in the results file for the users that do not have an image
+NO_IMAGE = "No image found"
+
+# The number of milliseconds in a year
+YEAR_MILLIS = 3.154 * 10 ** 10
+
+# The data of a user as read from a source csv file
+UserRecord = namedtuple('UserRecord', ['first_name', 'last_name', 'birthts'])
+
+# The columns of the source csv file of a single user
+USER_COLUMNS = ['first_name', 'last_name', 'birthts']
+
+
+class InvalidFileError(ValueError):
+    """
+    Raised when a source file cannot be processed, e.g. a csv file without the expected columns
+    """
+
 
 def make_2d_list(lst: list, k: int):
     """
@@ -20,32 +39,13 @@ def make_2d_list(lst: list, k: int):
     return rows
 
 
-def test_files_validity(minioClient: MyMinio, csv_files: list, image_files: list, bucket_name: str):
+def file_to_user_id(file_name: str):
     """
-    Check if the source data files are valid. Check if csv files contain three columns.
-    Check if csv files contain values for each of the three columns.
+    Extract the id of the user a source file belongs to, e.g. '1000.csv' -> '1000'
+    :param file_name: the name of the source file
+    :return: the id of the user
     """
-
-    assert (len(csv_files) >= len(image_files), "There are missing csv files. "
-                                                "There are more image files than csv.")
-
-    for csv_file in csv_files:
-
-        contents = minioClient.read_csv_file_from_minio(bucket_name, csv_file[0])
-
-        rows = make_2d_list(contents, 3)
-
-        assert (len([row for row in rows]) == 2)
-
-        for row in rows:
-            assert (len(row) == 3)
-
-        assert (rows[0][0].strip(), 'first_name', "No 'first_name' column")
-        assert (rows[0][1].strip(), 'last_name', "No 'last_name' column")
-        assert (rows[0][2].strip(), 'birthts', "No 'birthts' column")
-
-        for item in rows[1]:
-            assert (len(item.strip()) != 0, f"Empty field in file {csv_file[0]}")
+    return file_name[:file_name.find('.')]
 
 
 def millis_to_age(birthts: float):
@@ -55,7 +55,17 @@ def millis_to_age(birthts: float):
     :return:
     """
     now = time.time() * 1000
-    return (now - birthts) / (3.154 * 10 ** 10)
+    return (now - birthts) / YEAR_MILLIS
+
+
+def age_to_millis(age: float):
+    """
+    Transform from age in years to the timestamp ms of the birth of a user of that age
+    :param age: the age in years
+    :return: the timestamp ms
+    """
+    now = time.time() * 1000
+    return int(now - age * YEAR_MILLIS)
 
 
 def dict_to_list(user_info: dict):
@@ -63,6 +73,109 @@ def dict_to_list(user_info: dict):
             user_info['birthts'], user_info['img_path']]
 
 
+def dict_to_db_row(user_info: dict):
+    """
+    Transform the data of a user as written in the results file to a row of the 'users' table,
+    where birthts is an integer and img_path is None for the users that do not have an image
+    """
+    img_path = None if user_info['img_path'] == NO_IMAGE else user_info['img_path']
+    return [user_info['user_id'], user_info['first_name'], user_info['last_name'],
+            int(user_info['birthts']), img_path]
+
+
+def chunked(iterable, size: int):
+    """
+    Split an iterable into lists of 'size' items (the last list can be shorter) without reading
+    more than one list in memory at a time
+    :param iterable: the iterable to split
+    :param size: the number of items in each list
+    :return: a generator of the lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def user_shard(user_id: str, shards: int):
+    """
+    Get the shard of the results a user belongs to. The hash is stable across processes and restarts,
+    unlike the builtin 'hash' of strings.
+    :param user_id: the id of the user
+    :param shards: the number of shards
+    :return: the index of the shard, between 0 and shards - 1
+    """
+    return zlib.crc32(user_id.encode()) % shards
+
+
+def validate_header(columns: list, required: list):
+    """
+    Check the header of a source csv file
+    :param columns: the columns of the file, i.e. its header
+    :param required: the columns the file must have
+    :return: the reason why the header is invalid, or None if it is valid
+    """
+    if len(columns) == 0:
+        return "the file is empty"
+    missing = [column for column in required if column not in columns]
+    if missing:
+        return f"no {', '.join(repr(column) for column in missing)} column"
+    if len(set(columns)) != len(columns):
+        return "duplicate columns"
+    return None
+
+
+def parse_user_file(rows):
+    """
+    Check and parse the source csv file of a single user in a single pass. The file must have the columns
+    first_name, last_name and birthts and a single row of values, without empty values and with an integer birthts.
+    :param rows: an iterable of the rows of the file, e.g. the rows generated by 'MyMinio.iter_csv_file_from_minio'
+    :return: (record, reason) -> the 'UserRecord' of the user and None if the file is valid,
+    or None and the reason why the file is invalid
+    """
+    rows = iter(rows)
+    columns = next(rows, [])
+    reason = validate_header(columns, USER_COLUMNS)
+    if reason is not None:
+        return None, reason
+
+    record = None
+    for row in rows:
+        if record is not None:
+            return None, "more than one row of values"
+        reason = validate_user_row(row, columns)
+        if reason is not None:
+            return None, reason
+        record = UserRecord(row[columns.index('first_name')], row[columns.index('last_name')],
+                            int(row[columns.index('birthts')]))
+
+    if record is None:
+        return None, "no row of values"
+    return record, None
+
+
+def validate_user_row(row: list, columns: list):
+    """
+    Check a data row of a source csv file
+    :param row: the values of the row
+    :param columns: the columns of the file, i.e. its header
+    :return: the reason why the row is invalid, or None if it is valid
+    """
+    if len(row) != len(columns):
+        return f"expected {len(columns)} values but found {len(row)}"
+    for column, value in zip(columns, row):
+        if len(value) == 0:
+            return f"empty '{column}'"
+    birthts = row[columns.index('birthts')]
+    if not birthts.lstrip('-').isdigit():
+        return f"'birthts' is not an integer: {birthts}"
+    return None
+
+
 def extract_csv(file: _io.TextIOWrapper):
     """
     Extract the information about a specific user from 'file' which contains
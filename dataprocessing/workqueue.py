@@ -0,0 +1,138 @@
+import os
+import socket
+import uuid
+
+from dataprocessing.main import DataProcessing
+from dataprocessing.utils.helpers import file_to_user_id
+
+
+class DistributedIngest:
+
+    def __init__(self, data_processor: DataProcessing, worker_id: str = None, table_name: str = 'work_queue',
+                 batch_size: int = 500, lease_seconds: float = 600, max_attempts: int = 5, retry_delay: float = 60):
+        """
+        Splits the processing of the source data between several replicas of the service through a work queue
+        in postgres. One replica at a time compares the bucket with the manifest and queues the users whose
+        files changed (see 'plan'), and every replica claims batches of queued users and processes them
+        (see 'work'), so the replicas never process the same user at the same time.
+        :param data_processor: the data processing of this replica
+        :param worker_id: the id of this replica, unique among the replicas. By default, the host name,
+        the process id and a random suffix
+        :param table_name: the name of the queue table, see 'MyPgConnect.create_table_work_queue'
+        :param batch_size: the maximum number of users claimed and processed at a time
+        :param lease_seconds: the time a replica has to process a batch before the batch can be claimed
+        by another replica, e.g. if the replica crashed
+        :param max_attempts: the number of failed attempts after which a user is left in the queue
+        until the next plan
+        :param retry_delay: the number of seconds before a user that failed can be claimed again
+        """
+        self.data_processor = data_processor
+        self.pg_instance = data_processor.pg_instance
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def work_key(self, file_name: str):
+        """
+        Get the key of the work a source file belongs to: the id of its user, or the name of a bulk file
+        """
+        return file_name if self.data_processor.is_bulk_file(file_name) else file_to_user_id(file_name)
+
+    def enqueue(self, file_names):
+        """
+        Queues the users of some changed files, e.g. from the bucket notifications
+        :param file_names: the names of the changed files
+        :return: the number of queued keys
+        """
+        keys = sorted({self.work_key(file_name) for file_name in file_names})
+        self.pg_instance.enqueue_work(self.table_name, keys, self.max_attempts)
+        return len(keys)
+
+    def plan(self):
+        """
+        Queues the users whose files are new, changed or removed since they were last processed. Only one
+        replica plans at a time, the others skip the planning while it is in progress.
+        :return: the number of queued keys, or None if another replica is planning
+        """
+        with self.pg_instance.advisory_lock(f"{self.table_name}/plan", wait=False) as acquired:
+            if not acquired:
+                return None
+
+            files_info = self.data_processor.minioClient.get_files_info(self.data_processor.src_data_path)
+            manifest = self.pg_instance.get_manifest('manifest')
+            changed_files, removed_files = self.data_processor.plan_changes(files_info, manifest)
+
+            return self.enqueue(list(changed_files) + removed_files)
+
+    def pending(self):
+        """
+        :return: the number of keys that are waiting to be claimed
+        """
+        return self.pg_instance.count_work(self.table_name, self.max_attempts)['pending']
+
+    def _process(self, keys: list, progress, summary: dict):
+        """
+        Processes claimed keys and removes them from the queue
+        :return: the error if the processing failed, None otherwise
+        """
+        # the keys of the users stand for their csv files, the listing finds their other files
+        file_names = [key if self.data_processor.is_bulk_file(key) else f"{key}.csv" for key in keys]
+        try:
+            result = self.data_processor.process_data(progress=progress, keys=file_names)
+        except Exception as e:
+            print(f"Failed to process {len(keys)} queued keys: {e}")
+            return str(e) or type(e).__name__
+
+        self.pg_instance.complete_work(self.table_name, self.worker_id, keys)
+        for key, value in result.items():
+            summary[key] += value
+        summary['batches'] += 1
+        return None
+
+    def work(self, progress=None):
+        """
+        Claims and processes batches of queued users until the queue is empty. If a batch fails, its users
+        are processed one at a time, and the ones that still fail are given back to the queue to be retried
+        after 'retry_delay' seconds.
+        :param progress: the progress callback of 'DataProcessing.process_data'
+        :return: the sum of the summaries of the processed batches, with the number of 'batches' and of 'failed' keys
+        """
+        summary = {'users': 0, 'inserted': 0, 'updated': 0, 'deleted': 0, 'bulk_files': 0, 'invalid': 0,
+                   'quarantined': 0, 'thumbnails': 0, 'batches': 0, 'failed': 0}
+
+        while True:
+            keys = self.pg_instance.claim_work(self.table_name, self.worker_id, self.batch_size,
+                                               self.lease_seconds, self.max_attempts)
+            if len(keys) == 0:
+                return summary
+
+            error = self._process(keys, progress, summary)
+            if error is None:
+                continue
+
+            if len(keys) == 1:
+                errors = {keys[0]: error}
+            else:
+                # the batch is still leased, so the users can be retried one at a time
+                errors = {key: self._process([key], progress, summary) for key in keys}
+
+            for key, error in errors.items():
+                if error is not None:
+                    self.pg_instance.release_work(self.table_name, self.worker_id, [key], error, self.retry_delay)
+                    summary['failed'] += 1
+
+    def run(self, progress=None, keys=None):
+        """
+        Queues the changed users and processes the queue together with the other replicas.
+        Used as the run function of 'IngestJobs'.
+        :param progress: the progress callback of 'DataProcessing.process_data'
+        :param keys: if specified, the names of the changed files to queue instead of planning
+        :return: the summary of 'work' with the number of 'queued' keys (None if another replica was planning)
+        """
+        queued = self.plan() if keys is None else self.enqueue(keys)
+        summary = self.work(progress)
+        summary['queued'] = queued
+        return summary
@@ -0,0 +1,50 @@
+import argparse
+import time
+
+from dataprocessing.main import DataProcessing
+from dataprocessing.profiling import Profiler
+from dataprocessing.workqueue import DistributedIngest
+
+SRC_DATA_PATH = 'srcdata'
+PROCESSED_DATA_PATH = 'processeddata'
+
+
+if __name__ == "__main__":
+    # A worker that processes the source data together with the other workers and replicas of the service
+    # through the work queue in postgres, without the flask app. Start several of them to split the backlog.
+    parser = argparse.ArgumentParser(description="Process the source data as one of several workers")
+    parser.add_argument('--once', action='store_true', help="exit once the queue is empty")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--lease-seconds', type=float, default=600)
+    parser.add_argument('--poll-interval', type=float, default=5)
+    args = parser.parse_args()
+
+    data_processor = DataProcessing(SRC_DATA_PATH, PROCESSED_DATA_PATH, shared_locks=True)
+    data_processor.pg_instance.create_table_users()
+    data_processor.pg_instance.create_table_manifest()
+    data_processor.pg_instance.create_table_quarantine()
+    data_processor.pg_instance.create_table_bulk_file_ids()
+    data_processor.pg_instance.create_table_work_queue()
+    if data_processor.image_derivatives is not None:
+        data_processor.pg_instance.create_table_image_derivatives()
+
+    distributed_ingest = DistributedIngest(data_processor, batch_size=args.batch_size,
+                                           lease_seconds=args.lease_seconds)
+    # profile a sample of the runs, see PROFILE_INGEST_RATE
+    run = Profiler(data_processor.minioClient).wrap('ingest', distributed_ingest.run)
+    print(f"Worker {distributed_ingest.worker_id} started")
+
+    try:
+        while True:
+            started = time.monotonic()
+            summary = run()
+            if summary['batches'] != 0 or summary['failed'] != 0:
+                elapsed = time.monotonic() - started
+                print(f"Processed {summary['users']} users in {summary['batches']} batches in {elapsed:.1f}s "
+                      f"({summary['failed']} failed)")
+            # with --once, wait for the replica that is planning (if any) to queue its work first
+            if args.once and summary['queued'] is not None:
+                break
+            time.sleep(args.poll_interval)
+    finally:
+        data_processor.pg_instance.close()